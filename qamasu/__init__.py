@@ -23,31 +23,69 @@ SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
 CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, 
 OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF 
 THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."""
-try:
-  import json
-except ImportError:
-  import simplejson as json
-
 try:
   from django.utils import timezone as datetime
 except ImportError:
   from datetime import datetime
 from datetime import timedelta
+from collections import deque
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from random import uniform
+import threading
+import operator
+import errno
+import os
+import signal
 import time
 import logging
 
-from django.db import connection, transaction
+from django.db import connections, transaction, IntegrityError, DEFAULT_DB_ALIAS
+from django.db.models import F, Q, Count, Max, Min
 from uuid import uuid4 as uuid
 
 from django.conf import settings
 
-from qamasu.models import Func, Job, ExceptionLog
+from qamasu.models import Func, Job, ExceptionLog, QueueStat, Payload, Schedule, CompletedJob
+from qamasu.notifier import BackoffNotifier, PostgresNotifier, SocketNotifier, default_notifier
+from qamasu.metrics import Instrumentation, Metrics
+from qamasu.scheduling import WeightedScheduler, PriorityBandScheduler
+from qamasu import serializer
 
 RETRY_SECONDS = 5;
+MAX_RETRIES = 5;
+MAX_RETRY_DELAY = 3600;
 FIND_JOB_LIMIT_SIZE = 4;
+READY_SCAN_SIZE = 100;
+ENQUEUE_CHUNK_SIZE = 500;
+STATS_MAX_AGE = 10;
+OFFLOAD_THRESHOLD = 64 * 1024;
+SCHEDULE_CHECK_SECONDS = 1;
+COMPLETION_FLUSH_SECONDS = 1;
+ARCHIVE_PRUNE_SECONDS = 60;
+PRUNE_CHUNK_SIZE = 1000;
+RESTART_SECONDS = 1;
+# the largest PositiveSmallIntegerField on every backend.
+PRIORITY_MAX = 32767;
 
 logger = logging.getLogger('qamasu')
 
+try:
+  from django.core.exceptions import EmptyResultSet
+except ImportError:
+  from django.db.models.sql.datastructures import EmptyResultSet
+
+try:
+  atomic = transaction.atomic
+except AttributeError:
+  atomic = transaction.commit_on_success
+
+try:
+  autocommit = transaction.autocommit
+except AttributeError:
+  # Django 1.6 and later autocommit outside atomic blocks.
+  autocommit = lambda func: func
+
 def load_module(name):
   mod = __import__(name)
   components = name.split('.')
@@ -55,41 +93,307 @@ def load_module(name):
       mod = getattr(mod, comp)
   return mod
 
+def total_seconds(delta):
+  return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+def due_time(run_at=None, delay=None):
+  """
+  When a job enqueued with run_at or delay(seconds) becomes ready, None for now.
+  """
+  if delay is not None:
+    return datetime.now() + timedelta(seconds=delay)
+  return run_at
+
+def close_connections():
+  # a manager may use several databases(see qamasu.sharding).
+  for conn in connections.all():
+    conn.close()
+
+def backoff_seconds(retry_seconds, retry_cnt, max_delay=MAX_RETRY_DELAY):
+  """
+  Exponential backoff with jitter. Half of the delay is randomized
+  so that jobs failed together are not retried together.
+  """
+  delay = min(retry_seconds * (2 ** retry_cnt), max_delay)
+  return delay / 2.0 + uniform(0, delay / 2.0)
+
+class WorkerModule(object):
+  """
+  A worker module resolved once, with its GRAB_FOR and work_safely.
+  Optional HEARTBEAT in seconds renews the grab of running jobs by GRAB_FOR.
+  Optional MAX_RETRIES and RETRY_SECONDS override Manager's retry policy.
+  Optional SERIALIZER and COMPRESS_THRESHOLD choose how args are stored(see qamasu.serializer).
+  Optional COALESCE_WINDOW in seconds merges jobs enqueued with the same uniqkey into one,
+  by the module's merge_args(old_arg, new_arg) or keeping the latest arg.
+  Optional work_batch(manager, jobs) takes up to BATCH_SIZE jobs at once instead of work_safely.
+  """
+  def __init__(self, funcname):
+    self.funcname = funcname
+    self.module = load_module(funcname)
+    self.grab_for = self.module.GRAB_FOR
+    self.heartbeat = getattr(self.module, 'HEARTBEAT', None)
+    self.max_retries = getattr(self.module, 'MAX_RETRIES', None)
+    self.retry_seconds = getattr(self.module, 'RETRY_SECONDS', None)
+    self.serializer = getattr(self.module, 'SERIALIZER', 'json')
+    self.compress_threshold = getattr(self.module, 'COMPRESS_THRESHOLD', None)
+    self.coalesce_window = getattr(self.module, 'COALESCE_WINDOW', None)
+    self.merge_args = getattr(self.module, 'merge_args', None)
+    self.work_batch = getattr(self.module, 'work_batch', None)
+    self.batch_size = getattr(self.module, 'BATCH_SIZE', 1)
+    if self.work_batch is None:
+      self.work_safely = self.module.work_safely
+    else:
+      self.work_safely = getattr(self.module, 'work_safely', None)
+
+class Heartbeat(threading.Thread):
+  """
+  Extend the grab of jobs every interval seconds until stopped.
+  """
+  def __init__(self, jobs, interval, grab_for):
+    super(Heartbeat, self).__init__()
+    self.daemon = True
+    self.jobs = list(jobs)
+    self.interval = interval
+    self.grab_for = grab_for
+    self._stopped = threading.Event()
+
+  def run(self):
+    try:
+      while self.jobs and not self._stopped.wait(self.interval) and not self._stopped.is_set():
+        for job in list(self.jobs):
+          if job.is_completed or job.is_failed:
+            self.jobs.remove(job)
+          elif not job.extend(self.grab_for):
+            logger.warning('Job id:%d lost its grab.' % (job.id,))
+            self.jobs.remove(job)
+    finally:
+      close_connections()
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+
+class Prefetcher(threading.Thread):
+  """
+  Refill the prefetched jobs of manager in the background when asked.
+  """
+  def __init__(self, manager):
+    super(Prefetcher, self).__init__()
+    self.daemon = True
+    self.manager = manager
+    self.prioritizing = False
+    self._wanted = threading.Event()
+    self._stopped = threading.Event()
+
+  def run(self):
+    try:
+      while 1:
+        self._wanted.wait()
+        self._wanted.clear()
+        if self._stopped.is_set():
+          break
+        try:
+          self.manager._refill(self.prioritizing)
+        except Exception:
+          logger.exception('Prefetching jobs failed.')
+    finally:
+      close_connections()
+
+  def refill(self, prioritizing):
+    self.prioritizing = prioritizing
+    self._wanted.set()
+
+  def stop(self):
+    self._stopped.set()
+    self._wanted.set()
+    self.join()
+
+class Flusher(threading.Thread):
+  """
+  Flush the completed jobs buffered by manager every completion_flush_seconds,
+  also while the worker runs a long job or waits for jobs.
+  """
+  def __init__(self, manager):
+    super(Flusher, self).__init__()
+    self.daemon = True
+    self.manager = manager
+    self._stopped = threading.Event()
+
+  def run(self):
+    try:
+      while not self._stopped.wait(self.manager.completion_flush_seconds) and not self._stopped.is_set():
+        try:
+          self.manager.flush(force=False)
+        except Exception:
+          logger.exception('Flushing completed jobs failed.')
+    finally:
+      close_connections()
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+
 class QamasuJob(object):
-  def __init__(self, manager, job_data):
+  def __init__(self, manager, job_data, grab_token=None):
     self.id = job_data.id
+    self.grab_token = grab_token
     self.uniqkey = job_data.uniqkey
-    self.func_id = job_data.func.id
-    self.funcname = job_data.func.name
+    self.func_id = job_data.func_id
+    self.funcname = manager.worker(job_data.func_id).funcname
     self.retry_cnt = job_data.retry_cnt
     self.grabbed_until = job_data.grabbed_until
-    self.arg = json.loads(job_data.arg)
+    self._data = None
+    self._arg = None
+    self._arg_loaded = False
     self.manager = manager
     self.org_job = job_data
     self.completed = False
+    self.failed = False
     logger.debug('Job id:%d initialize complete.' % (self.id,))
   
+  @property
+  def data(self):
+    """
+    Serialized arg. Managers read it at grab, as complete deletes the job and its payload.
+    """
+    if self._data is None:
+      self._data = self.manager._arg_data(self.org_job)
+    return self._data
+
+  @property
+  def arg(self):
+    # decoded on first access, jobs not looking at arg never pay for it.
+    if not self._arg_loaded:
+      self._arg = serializer.loads(self.data)
+      self._arg_loaded = True
+    return self._arg
+
   def complete(self):
-    self.manager.dequeue(self)
+    self.manager.complete(self)
     self.completed = True
     logger.debug('Job id:%d completed.' % (self.id,))
   
+  def fail(self, exception):
+    """
+    Retry this job later, or move it to ExceptionLog after max retries, like a raising work_safely.
+    """
+    self.manager.retry_or_fail(self, exception)
+    self.failed = True
+
+  def extend(self, seconds):
+    """
+    Keep this job grabbed for seconds from now.
+    Returns False if the job is no longer grabbed by this worker.
+    """
+    return self.manager.extend(self, seconds)
+
   @property
   def is_completed(self):
     return self.completed
 
+  @property
+  def is_failed(self):
+    return self.failed
+
   def reenqueue(self, args):
     self.manager.reenqueue(self, args);
     logger.debug('Job id:%d retry(enqueued).' % (self.id,))
 
 
+class OptimisticGrabStrategy(object):
+  """
+  Grab a job by racing other workers with an UPDATE on grab_token.
+  Works on every backend.
+  """
+  def grab_one(self, manager, job_list):
+    # candidates are not grabbed yet, their args are loaded only for the grabbed one.
+    return manager._grab_a_job(job_list.defer('arg')[:manager.find_job_limit_size])
+
+  def grab_many(self, manager, job_list, n):
+    return manager._grab_jobs(job_list.values_list('id', 'func')[:n])
+
+
+class SkipLockedGrabStrategy(object):
+  """
+  Grab jobs locked with SELECT ... FOR UPDATE SKIP LOCKED.
+  Concurrent workers skip each other's rows, so every worker gets disjoint jobs.
+  PostgreSQL 9.5 and MySQL 8 only(see supports_skip_locked).
+  """
+  # select_for_update(skip_locked=True) needs Django 1.11, the clause is appended by hand.
+  lock_clause = ' FOR UPDATE SKIP LOCKED'
+
+  def grab_one(self, manager, job_list):
+    jobs = self.grab_many(manager, job_list, 1)
+    if jobs:
+      return jobs[0]
+    return None
+
+  def grab_many(self, manager, job_list, n):
+    query = job_list.values_list('id', 'func')[:n].query
+    try:
+      sql, params = query.get_compiler(using=manager.using).as_sql()
+    except EmptyResultSet:
+      # no ready job matched.
+      return []
+    with atomic(using=manager.using):
+      cursor = connections[manager.using].cursor()
+      cursor.execute(sql + self.lock_clause, params)
+      return manager._grab_jobs(cursor.fetchall())
+
+
+def supports_skip_locked(using=DEFAULT_DB_ALIAS):
+  connection = connections[using]
+  if connection.vendor == 'postgresql':
+    # pg_version of Django 1.5 reads the open connection.
+    connection.cursor()
+    return connection.pg_version >= 90500
+  if connection.vendor == 'mysql':
+    return connection.mysql_version >= (8, 0, 1)
+  return False
+
+
+def default_grab_strategy(using=DEFAULT_DB_ALIAS):
+  if supports_skip_locked(using):
+    return SkipLockedGrabStrategy()
+  return OptimisticGrabStrategy()
+
+
 class Manager(object):
-  def __init__(self, find_job_limit_size=4, retry_seconds=5, abilities=[]):
+  def __init__(self, find_job_limit_size=4, retry_seconds=5, abilities=[], grab_strategy=None,
+               notifier=None, max_retries=MAX_RETRIES, instrumentation=None,
+               offload_threshold=OFFLOAD_THRESHOLD, scheduler=None, completion_batch_size=None,
+               completion_flush_seconds=COMPLETION_FLUSH_SECONDS, archive_retention=None,
+               prefetch=0, prefetch_in_background=True, using=DEFAULT_DB_ALIAS):
+    self.using = using
     self.find_job_limit_size = find_job_limit_size
+    self.ready_scan_size = READY_SCAN_SIZE
+    self.prefetch = prefetch
+    self.prefetch_in_background = prefetch_in_background
+    self._prefetched = deque()
+    self._prefetch_lock = threading.Lock()
+    self._prefetcher = None
+    self.scheduler = scheduler
+    self.completion_batch_size = completion_batch_size
+    self.completion_flush_seconds = completion_flush_seconds
+    self.archive_retention = archive_retention
+    self._completed = []
+    self._completed_since = None
+    self._completed_lock = threading.Lock()
+    self._flusher = None
+    self._archive_pruned_at = 0
+    self.offload_threshold = offload_threshold
     self.retry_seconds = retry_seconds
+    self.max_retries = max_retries
+    self.instrumentation = instrumentation
+    self.grab_strategy = grab_strategy or default_grab_strategy(using)
+    self.notifier = notifier or default_notifier(using)
+    self._thread_pool = None
+    self._thread_pool_size = 0
     self.func_map = {}
     self.abilities = abilities
     self._func_id_cache = {}
+    self._worker_registry = {}
+    self._enqueue_workers = {}
     self.register_abilities(self.abilities)
     self.set_isolation_level = False
 
@@ -98,93 +402,1050 @@ class Manager(object):
       self.can_do(ability)
 
   def can_do(self, funcname):
-    load_module(funcname)
-    self.func_map[funcname] = 1
+    self.func_map[funcname] = WorkerModule(funcname)
+
+  def worker(self, func_id):
+    """
+    Returns the WorkerModule of func_id.
+    Abilities are resolved at register_abilities, others on first use.
+    """
+    worker = self._worker_registry.get(func_id, None)
+    if worker is None:
+      funcname = Func.objects.using(self.using).filter(pk=func_id).values_list('name', flat=True)[0]
+      worker = self.func_map.get(funcname, None) or WorkerModule(funcname)
+      self._func_id_cache[funcname] = func_id
+      self._worker_registry[func_id] = worker
+    return worker
 
   def has_abilities(self):
     return self.func_map.keys()
 
-  def enqueue(self, funcname, arg, uniqkey, priority=None):
+  def _func_id(self, funcname):
     func_id = self._func_id_cache.get(funcname, None)
     if not func_id:
-      func = Func.objects.get(name=funcname)
+      func = Func.objects.using(self.using).get(name=funcname)
       func_id = func.id
       self._func_id_cache[funcname] = func_id
-    json_arg = json.dumps(arg, ensure_ascii=False)
-    if priority:
-      job = Job(func_id=func_id, arg=json_arg, uniqkey=uniqkey, priority=priority)
-    else:
-      job = Job(func_id=func_id, arg=json_arg, uniqkey=uniqkey)
-    job.save()
+    return func_id
+
+  def _enqueue_worker(self, funcname):
+    """
+    WorkerModule of funcname for enqueueing, None if it can not be loaded here.
+    """
+    worker = self.func_map.get(funcname, None)
+    if worker is None:
+      if funcname not in self._enqueue_workers:
+        try:
+          self._enqueue_workers[funcname] = WorkerModule(funcname)
+        except (ImportError, AttributeError):
+          self._enqueue_workers[funcname] = None
+      worker = self._enqueue_workers[funcname]
+    return worker
+
+  def _serialize(self, funcname, arg):
+    worker = self._enqueue_worker(funcname)
+    if worker is None:
+      # stored args are self describing, so JSON is always safe.
+      return serializer.dumps(arg)
+    return serializer.dumps(arg, worker.serializer, worker.compress_threshold)
+
+  def _job_arg(self, funcname, arg):
+    """
+    Returns kwargs of Job for arg. An arg of offload_threshold or longer is saved as Payload.
+    """
+    return self._stored_arg(self._serialize(funcname, arg))
+
+  def _stored_arg(self, data):
+    if self.offload_threshold is None or len(data) < self.offload_threshold:
+      return dict(arg=data)
+    payload = Payload(data=data)
+    payload.save(using=self.using)
+    return dict(arg='', payload_id=payload.id)
+
+  def _arg_data(self, job_data):
+    if job_data.payload_id:
+      return Payload.objects.using(self.using).filter(pk=job_data.payload_id).values_list('data', flat=True)[0]
+    return job_data.arg
+
+  def _load_data(self, jobs):
+    """
+    Read the serialized args of grabbed jobs, their payloads with one query.
+    """
+    payload_ids = [job.org_job.payload_id for job in jobs if job.org_job.payload_id]
+    payloads = {}
+    if payload_ids:
+      payloads = dict(Payload.objects.using(self.using).filter(pk__in=payload_ids).values_list('id', 'data'))
+    for job in jobs:
+      if job.org_job.payload_id:
+        job._data = payloads.get(job.org_job.payload_id)
+      else:
+        job._data = job.org_job.arg
+
+  def _pending(self, func_id, uniqkeys):
+    """
+    Jobs of uniqkeys not running now, waiting in the queue or for retry.
+    """
+    return Job.objects.using(self.using).filter(func=func_id, uniqkey__in=uniqkeys).filter(
+             Q(grab_token='') | Q(grabbed_until__lte=datetime.now()))
+
+  def _insert_ignore_sql(self):
+    connection = connections[self.using]
+    if connection.vendor == 'sqlite':
+      return 'INSERT OR IGNORE INTO %s (%s) VALUES %s'
+    if connection.vendor == 'mysql':
+      return 'INSERT IGNORE INTO %s (%s) VALUES %s'
+    if connection.vendor == 'postgresql':
+      connection.cursor()
+      if connection.pg_version >= 90500:
+        return 'INSERT INTO %s (%s) VALUES %s ON CONFLICT DO NOTHING'
+    return None
+
+  def _insert_unique(self, jobs):
+    """
+    Insert jobs but those whose dedup_key is taken by a pending job, without raising.
+    Returns the number of inserted jobs.
+    """
+    # the insert ignores other errors too(SQLite) or truncates(MySQL), so values are checked here.
+    uniqkey_length = Job._meta.get_field('uniqkey').max_length
+    for job in jobs:
+      if not 0 <= job.priority <= PRIORITY_MAX:
+        raise ValueError('priority must be between 0 and %d, not %r.' % (PRIORITY_MAX, job.priority))
+      if len(job.uniqkey) > uniqkey_length:
+        raise ValueError('uniqkey must be %d characters or less, not %r.' % (uniqkey_length, job.uniqkey))
+    now = datetime.now()
+    for job in jobs:
+      job.enqueue_time = job.enqueue_time or now
+      job.grabbed_until = job.grabbed_until or now
+    sql = self._insert_ignore_sql()
+    if sql is None:
+      inserted = 0
+      for job in jobs:
+        try:
+          with atomic(using=self.using):
+            job.save(using=self.using, force_insert=True)
+          inserted += 1
+        except IntegrityError:
+          pass
+      return inserted
+    connection = connections[self.using]
+    fields = [field for field in Job._meta.local_concrete_fields if field is not Job._meta.pk]
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    row = '(%s)' % ', '.join(['%s'] * len(fields))
+    batch_size = max(connection.ops.bulk_batch_size(fields, jobs), 1)
+    inserted = 0
+    cursor = connection.cursor()
+    for start in xrange(0, len(jobs), batch_size):
+      batch = jobs[start:start + batch_size]
+      params = []
+      for job in batch:
+        params.extend(field.get_db_prep_save(getattr(job, field.attname), connection=connection)
+                      for field in fields)
+      cursor.execute(sql % (Job._meta.db_table, columns, ', '.join([row] * len(batch))), params)
+      inserted += cursor.rowcount
+    return inserted
+
+  def _delete_orphan_payloads(self, payload_ids):
+    if payload_ids:
+      used = Job.objects.using(self.using).filter(payload_id__in=payload_ids).values_list('payload_id', flat=True)
+      Payload.objects.using(self.using).filter(pk__in=set(payload_ids) - set(used)).delete()
+
+  def _coalesce(self, worker, func_id, arg, uniqkey, priority):
+    """
+    Merge arg into the pending job of uniqkey and return it, None without pending job.
+    """
+    pending = list(self._pending(func_id, [uniqkey]).select_for_update()[:1])
+    if not pending:
+      return None
+    job = pending[0]
+    if worker.merge_args:
+      arg = worker.merge_args(serializer.loads(self._arg_data(job)), arg)
+    fields = dict(payload_id=None)
+    fields.update(self._job_arg(worker.funcname, arg))
+    if priority and priority < job.priority:
+      fields['priority'] = priority
+    # the row lock is not taken everywhere(SQLite), so the job must still be pending.
+    if not self._pending(func_id, [uniqkey]).filter(pk=job.id).update(**fields):
+      if fields['payload_id']:
+        Payload.objects.using(self.using).filter(pk=fields['payload_id']).delete()
+      logger.debug('Job id:%d was grabbed while coalescing %s.' % (job.id, uniqkey))
+      return None
+    if job.payload_id:
+      Payload.objects.using(self.using).filter(pk=job.payload_id).delete()
+    for name, value in fields.items():
+      setattr(job, name, value)
+    logger.debug('Job id:%d coalesced for %s.' % (job.id, uniqkey))
+    return job
+
+  def enqueue(self, funcname, arg, uniqkey, priority=None, unique=False, run_at=None, delay=None):
+    """
+    The job is found from run_at, or delay seconds later, if given.
+    With unique, a pending job of the same uniqkey is returned instead of a new one.
+    Its priority is raised to priority if that is higher(smaller).
+    A job of a coalescing worker runs COALESCE_WINDOW seconds later and
+    args enqueued with its uniqkey until then are merged into it.
+    """
+    func_id = self._func_id(funcname)
+    worker = self._enqueue_worker(funcname)
+    coalesce_window = worker and worker.coalesce_window
+    grabbed_until = due_time(run_at, delay)
+    if coalesce_window:
+      window_end = datetime.now() + timedelta(seconds=coalesce_window)
+      grabbed_until = max(grabbed_until or window_end, window_end)
+    with atomic(using=self.using):
+      if coalesce_window:
+        job = self._coalesce(worker, func_id, arg, uniqkey, priority)
+        if job:
+          return job
+      elif unique:
+        pending = self._pending(func_id, [uniqkey])
+        if priority:
+          pending.filter(priority__gt=priority).update(priority=priority)
+        pending = list(pending.defer('arg')[:1])
+        if pending:
+          logger.debug('Job id:%d is pending for %s.' % (pending[0].id, uniqkey))
+          return pending[0]
+      if priority:
+        job = Job(func_id=func_id, uniqkey=uniqkey, priority=priority, **self._job_arg(funcname, arg))
+      else:
+        job = Job(func_id=func_id, uniqkey=uniqkey, **self._job_arg(funcname, arg))
+      if grabbed_until:
+        job.grabbed_until = grabbed_until
+      if unique:
+        job.dedup_key = uniqkey
+        # the holder of uniqkey may be grabbed before it is found, then it is tried once more.
+        for attempt in range(2):
+          inserted = self._insert_unique([job])
+          # ours, or the pending job of a producer enqueueing uniqkey at the same moment.
+          found = list(Job.objects.using(self.using).select_for_update().filter(func=func_id, dedup_key=uniqkey))
+          if found:
+            break
+        else:
+          raise IntegrityError('Job of %s for %s was neither inserted nor found.' % (uniqkey, funcname))
+        if not inserted:
+          if job.payload_id:
+            self._delete_orphan_payloads([job.payload_id])
+          logger.debug('Job id:%d is pending for %s.' % (found[0].id, uniqkey))
+          return found[0]
+        job = found[0]
+      else:
+        job.save(using=self.using)
+    self.notifier.notify()
     return job
+
+  def enqueue_many(self, funcname, args, priority=None, chunk_size=ENQUEUE_CHUNK_SIZE,
+                   uniqkey=None, unique=False, run_at=None, delay=None):
+    """
+    Insert a job for each arg of args with bulk_create, chunk_size rows at a time.
+    args may be a generator; only one chunk is held in memory.
+    uniqkey is a function returning the uniqkey of an arg, random by default.
+    With unique, args of pending uniqkeys are skipped like enqueue, the rest is inserted
+    skipping uniqkeys taken meanwhile.
+    Args of a coalescing worker are enqueued one by one to be merged.
+    Returns the number of enqueued jobs.
+    """
+    if unique and uniqkey is None:
+      raise ValueError('unique enqueue_many needs uniqkey.')
+    worker = self._enqueue_worker(funcname)
+    if worker and worker.coalesce_window and uniqkey:
+      count = 0
+      for arg in args:
+        self.enqueue(funcname, arg, uniqkey(arg), priority=priority, run_at=run_at, delay=delay)
+        count += 1
+      return count
+    func_id = self._func_id(funcname)
+    extra = {}
+    if priority:
+      extra['priority'] = priority
+    grabbed_until = due_time(run_at, delay)
+    args = iter(args)
+    count = 0
+    while 1:
+      chunk = list(islice(args, chunk_size))
+      if not chunk:
+        break
+      if uniqkey:
+        keyed = [(uniqkey(arg), arg) for arg in chunk]
+      else:
+        keyed = [(uuid().hex, arg) for arg in chunk]
+      now = datetime.now()
+      with atomic(using=self.using):
+        if unique:
+          keys = [key for key, arg in keyed]
+          pending = self._pending(func_id, keys)
+          if priority:
+            pending.filter(priority__gt=priority).update(priority=priority)
+          seen = set(pending.values_list('uniqkey', flat=True))
+          new = []
+          for key, arg in keyed:
+            if key not in seen:
+              seen.add(key)
+              new.append((key, arg))
+          keyed = new
+        jobs = [Job(func_id=func_id, uniqkey=key, enqueue_time=now, grabbed_until=grabbed_until or now,
+                    **dict(extra, **self._job_arg(funcname, arg)))
+                for key, arg in keyed]
+        if unique:
+          for job in jobs:
+            job.dedup_key = job.uniqkey
+          inserted = self._insert_unique(jobs)
+          if inserted < len(jobs):
+            self._delete_orphan_payloads([job.payload_id for job in jobs if job.payload_id])
+          count += inserted
+        else:
+          Job.objects.using(self.using).bulk_create(jobs)
+          count += len(jobs)
+    if count:
+      self.notifier.notify()
+    logger.debug('%d jobs enqueued for %s.' % (count, funcname))
+    return count
   
   def reenqueue(self, job_data, args):
-    job = Job.objects.get(pk=job_data.id)
+    job = Job.objects.using(self.using).get(pk=job_data.id)
     for k,v in args.items():
-      if has_attr(job.k):
+      if hasattr(job, k):
         setattr(job, k, v)
-    job.save()
-    return Job.objects.get(pk=job_data.id)
+    job.save(using=self.using)
+    return Job.objects.using(self.using).get(pk=job_data.id)
 
   def dequeue(self, job):
-    Job.objects.filter(pk=job.id).delete()
+    Job.objects.using(self.using).filter(pk=job.id).delete()
+    if job.org_job.payload_id:
+      Payload.objects.using(self.using).filter(pk=job.org_job.payload_id).delete()
+
+  def complete(self, job):
+    """
+    Remove job at once, or with completion_batch_size, when that many jobs are completed
+    or the first of them is completion_flush_seconds old(checked by a Flusher thread).
+    A job whose grab ends before it would be flushed that way is flushed at once.
+    Buffered jobs stay grabbed until flushed; a crash lets them run again after GRAB_FOR.
+    """
+    if not self.completion_batch_size:
+      self._complete_jobs([job])
+      return
+    self._completed_lock.acquire()
+    try:
+      if not self._completed:
+        self._completed_since = time.time()
+      self._completed.append(job)
+      full = len(self._completed) >= self.completion_batch_size
+      if self._flusher is None:
+        self._flusher = Flusher(self)
+        self._flusher.start()
+    finally:
+      self._completed_lock.release()
+    expiring = total_seconds(job.grabbed_until - datetime.now()) < self.completion_flush_seconds * 2
+    self.flush(force=full or expiring)
+
+  def flush(self, force=True):
+    """
+    Remove buffered completed jobs, unless not force and they are younger than completion_flush_seconds.
+    """
+    self._completed_lock.acquire()
+    try:
+      if not self._completed:
+        return 0
+      if not force and time.time() - self._completed_since < self.completion_flush_seconds:
+        return 0
+      jobs = self._completed
+      self._completed = []
+    finally:
+      self._completed_lock.release()
+    try:
+      self._complete_jobs(jobs)
+    except Exception:
+      # kept for the next flush instead of running again after GRAB_FOR.
+      self._completed_lock.acquire()
+      try:
+        self._completed[:0] = jobs
+      finally:
+        self._completed_lock.release()
+      raise
+    logger.debug('%d completed jobs flushed.' % len(jobs))
+    return len(jobs)
+
+  def _complete_jobs(self, jobs):
+    ids_by_token = {}
+    for job in jobs:
+      ids_by_token.setdefault(job.grab_token, []).append(job.id)
+    # a job whose grab ran out may be grabbed by another worker now, which owns it then.
+    owned = reduce(operator.or_, [Q(id__in=ids, grab_token=grab_token) for grab_token, ids in ids_by_token.items()])
+    with atomic(using=self.using):
+      query = Job.objects.using(self.using).filter(owned)
+      if self.archive_retention or [job for job in jobs if job.org_job.payload_id]:
+        ids = set(query.select_for_update().values_list('id', flat=True))
+        jobs = [job for job in jobs if job.id in ids]
+      if self.archive_retention:
+        now = datetime.now()
+        CompletedJob.objects.using(self.using).bulk_create([CompletedJob(job_id=job.id, func_id=job.func_id, uniqkey=job.uniqkey,
+                                                       enqueue_time=job.org_job.enqueue_time, completed_at=now,
+                                                       retry_cnt=job.retry_cnt)
+                                          for job in jobs])
+      query.delete()
+      payload_ids = [job.org_job.payload_id for job in jobs if job.org_job.payload_id]
+      if payload_ids:
+        Payload.objects.using(self.using).filter(id__in=payload_ids).delete()
+    if self.archive_retention and time.time() - self._archive_pruned_at >= ARCHIVE_PRUNE_SECONDS:
+      self.prune_archive()
+
+  def prune_archive(self, retention=None):
+    """
+    Delete archived jobs completed more than retention(archive_retention by default) seconds ago.
+    """
+    self._archive_pruned_at = time.time()
+    retention = retention or self.archive_retention
+    CompletedJob.objects.using(self.using).filter(completed_at__lt=datetime.now() - timedelta(seconds=retention)).delete()
+
+  def extend(self, job, seconds):
+    grabbed_until = datetime.now() + timedelta(seconds=seconds)
+    extended = Job.objects.using(self.using).filter(pk=job.id, grab_token=job.grab_token).update(grabbed_until=grabbed_until)
+    if extended:
+      job.grabbed_until = grabbed_until
+      logger.debug('Job id:%d grabbed until %s.' % (job.id, grabbed_until))
+    return bool(extended)
   
-  @transaction.autocommit
+  @autocommit
   def work_once(self, prioritizing=False):
     job = self.find_job(prioritizing=prioritizing)
     if not job:
       logger.debug('No Job.')
       return None
-    worker_module = load_module(job.funcname)
+    return self._work(self._batches([job], prioritizing)[0])
+
+  @autocommit
+  def work_batch(self, batch_size, prioritizing=False):
+    if batch_size > 1:
+      jobs = self.find_jobs(batch_size, prioritizing=prioritizing)
+    else:
+      job = self.find_job(prioritizing=prioritizing)
+      jobs = job and [job] or []
+    if not jobs:
+      logger.debug('No Job.')
+      return 0
+    units = self._batches(jobs, prioritizing)
+    worked = []
+    for unit in units:
+      # jobs wait for the ones before them, their grabs may have run out meanwhile.
+      unit = self._renewed(unit)
+      if unit:
+        self._work(unit)
+        worked.append(unit)
+    return self._count(worked)
+
+  def _renewed(self, unit):
+    """
+    Jobs of unit still grabbed by this worker, their grabs renewed like prefetched jobs.
+    A job whose grab was lost may run on another worker, so it is skipped.
+    """
+    jobs = isinstance(unit, list) and unit or [unit]
+    kept = []
+    for job in jobs:
+      if job.manager._renew(job):
+        kept.append(job)
+      else:
+        logger.warning('Job id:%d lost its grab before it ran.' % (job.id,))
+    if isinstance(unit, list):
+      return kept
+    return kept and kept[0] or None
+
+  def _batches(self, jobs, prioritizing=False):
+    """
+    Group jobs of work_batch modules by function into lists of up to BATCH_SIZE jobs,
+    filled up with more jobs of the function. Other jobs are returned as they are.
+    """
+    units = []
+    groups = {}
+    for job in jobs:
+      worker = job.manager.worker(job.func_id)
+      if worker.work_batch is None:
+        units.append(job)
+        continue
+      key = (job.manager, job.func_id)
+      group = groups.get(key)
+      if group is None or len(group) >= worker.batch_size:
+        group = groups[key] = []
+        units.append(group)
+      group.append(job)
+    for (manager, func_id), group in groups.items():
+      wanted = manager.worker(func_id).batch_size - len(group)
+      if wanted > 0:
+        group.extend(manager.find_func_jobs(func_id, wanted, prioritizing=prioritizing))
+    return units
+
+  def _count(self, units):
+    return sum(isinstance(unit, list) and len(unit) or 1 for unit in units)
+
+  def _work(self, unit):
+    if isinstance(unit, list):
+      return self._work_jobs(unit)
+    return self._work_job(unit)
+
+  def _work_jobs(self, jobs):
+    """
+    Pass jobs of a function to work_batch of its module, which completes or fails each of them.
+    If it raises, the jobs it has not completed nor failed are retried or failed.
+    """
+    worker = jobs[0].manager.worker(jobs[0].func_id)
+    instrumentation = self.instrumentation
+    if instrumentation:
+      now = datetime.now()
+      for job in jobs:
+        instrumentation.job_started(job.funcname, total_seconds(now - job.org_job.enqueue_time))
+      started = time.time()
+    heartbeat = None
+    if worker.heartbeat:
+      heartbeat = Heartbeat(jobs, worker.heartbeat, worker.grab_for)
+      heartbeat.start()
     res = None
     try:
-      res = worker_module.work_safely(self, job)
-    except Exception, e:
-      self.job_failed(job.org_job, e)
+      try:
+        res = worker.work_batch(self, jobs)
+      except Exception, e:
+        for job in jobs:
+          if not job.is_completed and not job.is_failed:
+            job.fail(e)
+    finally:
+      if heartbeat:
+        heartbeat.stop()
+      if instrumentation:
+        for job in jobs:
+          instrumentation.job_finished(job.funcname, time.time() - started, job.is_failed)
     return res
+
+  def _work_job(self, job):
+    # job.manager owns the job; it is another manager than self when sharded.
+    worker = job.manager.worker(job.func_id)
+    instrumentation = self.instrumentation
+    if instrumentation:
+      instrumentation.job_started(job.funcname, total_seconds(datetime.now() - job.org_job.enqueue_time))
+      started = time.time()
+    heartbeat = None
+    if worker.heartbeat:
+      heartbeat = Heartbeat([job], worker.heartbeat, worker.grab_for)
+      heartbeat.start()
+    res = None
+    failed = False
+    try:
+      try:
+        res = worker.work_safely(self, job)
+      except Exception, e:
+        failed = True
+        job.manager.retry_or_fail(job, e)
+    finally:
+      if heartbeat:
+        heartbeat.stop()
+      if instrumentation:
+        instrumentation.job_finished(job.funcname, time.time() - started, failed)
+    return res
+
+  @autocommit
+  def work_concurrently(self, concurrency, prioritizing=False):
+    """
+    Grab up to concurrency jobs and run them at once on a thread pool.
+    Every grabbed job starts immediately, so no job waits beyond its GRAB_FOR in a queue.
+    """
+    jobs = self.find_jobs(concurrency, prioritizing=prioritizing)
+    if not jobs:
+      logger.debug('No Job.')
+      return 0
+    units = self._batches(jobs, prioritizing)
+    # every thread of the pool uses its own database connection.
+    # get re-raises an exception a worker thread did not handle.
+    self._get_thread_pool(concurrency).map_async(self._work, units).get()
+    return self._count(units)
+
+  def _get_thread_pool(self, size):
+    if self._thread_pool is None or self._thread_pool_size != size:
+      self._close_thread_pool()
+      self._thread_pool = ThreadPool(size)
+      self._thread_pool_size = size
+    return self._thread_pool
+
+  def close(self):
+    if self._flusher is not None:
+      self._flusher.stop()
+      self._flusher = None
+    self.flush()
+    if self._prefetcher is not None:
+      self._prefetcher.stop()
+      self._prefetcher = None
+    if self._prefetched:
+      self.release(list(self._prefetched))
+      self._prefetched.clear()
+    self._close_thread_pool()
+
+  def _close_thread_pool(self):
+    if self._thread_pool is not None:
+      self._thread_pool.close()
+      self._thread_pool.join()
+      self._thread_pool = None
   
   def lookup_job(self, job_id):
-    job_list = Job.objects.filter(pk=job_id)
+    job_list = Job.objects.using(self.using).filter(pk=job_id)
     return self._grab_a_job(job_list)
   
   def find_job(self, prioritizing=False):
-    job_list = Job.objects.filter(func__name__in=self.func_map.keys(),
-      grabbed_until__lte=datetime.now())
-    if prioritizing:
-      job_list = job_list.order_by('priority', 'id')
+    if self.prefetch:
+      return self._prefetched_job(prioritizing)
+    if not self.instrumentation:
+      return self._find_job(prioritizing)
+    started = time.time()
+    job = self._find_job(prioritizing)
+    self.instrumentation.find_job(time.time() - started, int(job is not None))
+    return job
+
+  def find_jobs(self, n, prioritizing=False):
+    if not self.instrumentation:
+      return self._find_jobs(n, prioritizing)
+    started = time.time()
+    jobs = self._find_jobs(n, prioritizing)
+    self.instrumentation.find_job(time.time() - started, len(jobs))
+    return jobs
+
+  def find_func_jobs(self, func_id, n, prioritizing=False):
+    """
+    Grab up to n jobs of func_id, to fill a batch of its work_batch.
+    """
+    if not self.instrumentation:
+      return self._find_func_jobs(func_id, n, prioritizing)
+    started = time.time()
+    jobs = self._find_func_jobs(func_id, n, prioritizing)
+    self.instrumentation.find_job(time.time() - started, len(jobs))
+    return jobs
+
+  def _prefetched_job(self, prioritizing):
+    """
+    Serve a job grabbed ahead, refilling prefetch jobs when half of them are served.
+    """
+    while 1:
+      if not self._prefetched:
+        self._refill(prioritizing)
+        if not self._prefetched:
+          return None
+      job = self._prefetched.popleft()
+      if len(self._prefetched) <= self.prefetch // 2 and self.prefetch_in_background:
+        if self._prefetcher is None:
+          self._prefetcher = Prefetcher(self)
+          self._prefetcher.start()
+        self._prefetcher.refill(prioritizing)
+      if self._renew(job):
+        return job
+      logger.debug('Prefetched job id:%d lost its grab.' % (job.id,))
+
+  def _refill(self, prioritizing):
+    self._prefetch_lock.acquire()
+    try:
+      wanted = self.prefetch - len(self._prefetched)
+      if wanted > 0:
+        self._prefetched.extend(self.find_jobs(wanted, prioritizing=prioritizing))
+    finally:
+      self._prefetch_lock.release()
+
+  def _renew(self, job):
+    """
+    Extend the grab of a prefetched job by GRAB_FOR when half of it has passed in the buffer.
+    """
+    grab_for = job.manager.worker(job.func_id).grab_for
+    if total_seconds(job.grabbed_until - datetime.now()) >= grab_for / 2.0:
+      return True
+    return job.extend(grab_for)
+
+  def release(self, jobs):
+    """
+    Give up the grab of jobs not worked, so that other workers take them at once.
+    """
+    ids_by_token = {}
+    for job in jobs:
+      ids_by_token.setdefault(job.grab_token, []).append(job.id)
+    now = datetime.now()
+    for grab_token, ids in ids_by_token.items():
+      Job.objects.using(self.using).filter(id__in=ids, grab_token=grab_token).update(grab_token='', grabbed_until=now)
+    logger.debug('%d jobs released.' % len(jobs))
+
+  def _find_job(self, prioritizing):
+    if self.scheduler:
+      jobs = self._find_scheduled_jobs(1, prioritizing)
     else:
-      job_list = job_list.order_by('id')
-    return self._grab_a_job(job_list[:self.find_job_limit_size])
+      jobs = self._find_merged_jobs(1, prioritizing)
+    return jobs and jobs[0] or None
+
+  def _find_jobs(self, n, prioritizing):
+    if self.scheduler:
+      return self._find_scheduled_jobs(n, prioritizing)
+    return self._find_merged_jobs(n, prioritizing)
+
+  def _find_func_jobs(self, func_id, n, prioritizing):
+    return self._grab_from(func_id, self._ready_ids(func_id, prioritizing, n), n, prioritizing)
+
+  def _grab_from(self, func_id, ready, n, prioritizing):
+    if not ready:
+      return []
+    candidates = self._candidates(ready, prioritizing)
+    if n > 1:
+      return self.grab_strategy.grab_many(self, candidates, n)
+    job = self.grab_strategy.grab_one(self, candidates)
+    return job and [job] or []
+
+  def _find_merged_jobs(self, n, prioritizing):
+    """
+    Take the oldest(or most prior) n jobs of all abilities, a query per function.
+    A query over several functions would sort all their ready jobs, so the first n
+    of each function are merged, and each function grabs its part.
+    """
+    ready = {}
+    for func_id in self._ability_func_ids():
+      ids = self._ready_ids(func_id, prioritizing, n)
+      if ids:
+        ready[func_id] = ids
+    if not ready:
+      return []
+    if len(ready) == 1:
+      func_id, ids = ready.items()[0]
+      return self._grab_from(func_id, ids, n, prioritizing)
+    heads = []
+    for func_id, ids in ready.items():
+      if prioritizing:
+        keys = self._candidates(ids, prioritizing).values_list('priority', 'id')[:n]
+      else:
+        keys = [(job_id,) for job_id in sorted(ids)[:n]]
+      heads.extend((key, func_id) for key in keys)
+    heads = sorted(heads)[:n]
+    shares = {}
+    for key, func_id in heads:
+      shares[func_id] = shares.get(func_id, 0) + 1
+    jobs = []
+    wanted = 0
+    for key, func_id in heads:
+      if func_id in shares:
+        # jobs lost to other workers are made up by the next function.
+        wanted += shares.pop(func_id)
+        found = self._grab_from(func_id, ready[func_id], wanted, prioritizing)
+        jobs.extend(found)
+        wanted -= len(found)
+    rank = dict((key[-1], i) for i, (key, func_id) in enumerate(heads))
+    jobs.sort(key=lambda job: rank.get(job.id, n))
+    return jobs
+
+  def _find_scheduled_jobs(self, n, prioritizing):
+    """
+    Look for jobs function by function in the order of scheduler, a query per function.
+    Each function takes its share of n, and what it lacks passes to the next.
+    """
+    func_ids = dict((self.worker(func_id).funcname, func_id) for func_id in self._ability_func_ids())
+    funcnames = list(func_ids)
+    jobs = []
+    wanted = 0
+    for funcname, share in self.scheduler.order(funcnames, n):
+      wanted = min(wanted + share, n - len(jobs))
+      if not wanted:
+        continue
+      func_id = func_ids[funcname]
+      found = self._grab_from(func_id, self._ready_ids(func_id, prioritizing, wanted), wanted, prioritizing)
+      if found:
+        self.scheduler.picked(funcnames, funcname, len(found))
+        jobs.extend(found)
+      if len(found) < wanted:
+        self.scheduler.empty(funcname)
+      wanted -= len(found)
+      if len(jobs) >= n:
+        break
+    return jobs
+
+  def _ability_func_ids(self):
+    missing = [name for name in self.func_map if name not in self._func_id_cache]
+    if missing:
+      for func_id, name in Func.objects.using(self.using).filter(name__in=missing).values_list('id', 'name'):
+        self._func_id_cache[name] = func_id
+        self._worker_registry[func_id] = self.func_map[name]
+    return [self._func_id_cache[name] for name in self.func_map if name in self._func_id_cache]
+
+  def _ready_jobs(self, func_id, now):
+    return Job.objects.using(self.using).filter(func=func_id, grabbed_until__lte=now).order_by('grabbed_until')
+
+  def _in_order(self, job_list, prioritizing=False):
+    if prioritizing:
+      return job_list.order_by('priority', 'id')
+    return job_list.order_by('id')
+
+  def _ordered_jobs(self, func_id, prioritizing=False):
+    return self._in_order(Job.objects.using(self.using).filter(func=func_id), prioritizing)
+
+  def _ready_ids(self, func_id, prioritizing=False, n=1):
+    """
+    Ids of ready jobs of a function to grab in find_job order, at least n if there are.
+    Up to ready_scan_size ready jobs are read in the order they are due, so delayed and
+    running jobs are not read. Of a larger backlog, the ready ones of its head are taken
+    by the index of find_job order, or the ones due first if its head is not ready.
+    Every poll reads ready_scan_size rows, as a query on grabbed_until in find_job order
+    would sort all ready jobs.
+    """
+    size = max(self.ready_scan_size, n)
+    now = datetime.now()
+    ready = list(self._ready_jobs(func_id, now).values_list('id', flat=True)[:size])
+    if len(ready) == size:
+      head = self._ordered_jobs(func_id, prioritizing).values_list('id', 'grabbed_until')[:size]
+      ready = [job_id for job_id, grabbed_until in head if grabbed_until <= now] or ready
+    return ready
+
+  def _candidates(self, ready, prioritizing=False):
+    # looked up by their ids; by func, the database would read all jobs of the function.
+    job_list = Job.objects.using(self.using).filter(id__in=ready, grabbed_until__lte=datetime.now())
+    return self._in_order(job_list, prioritizing)
 
   def _grab_a_job(self, job_list):
     for job_data in job_list:
       old_grabbed_until = job_data.grabbed_until;
       server_time = datetime.now() #TODO
 
-      worker_mod = load_module(job_data.func.name);
-      new_uniqkey = uuid().hex
-      grabbed = Job.objects.filter(
-                              uniqkey=job_data.uniqkey,
+      worker = self.worker(job_data.func_id)
+      grab_token = uuid().hex
+      grabbed = Job.objects.using(self.using).filter(
+                              pk=job_data.id,
+                              grab_token=job_data.grab_token,
                               grabbed_until__lte=server_time
                           ).update(
-                            uniqkey=new_uniqkey,
-                            grabbed_until=server_time + timedelta(seconds=worker_mod.GRAB_FOR)
+                            grab_token=grab_token,
+                            grabbed_until=server_time + timedelta(seconds=worker.grab_for),
+                            # running, so its uniqkey can be enqueued again.
+                            dedup_key=None
                           )
+      if self.instrumentation:
+        self.instrumentation.grab(worker.funcname, 1, int(not grabbed))
       if not grabbed:
         logger.debug("job(%d) is not found. Could be grabbed another worker.", job_data.id)
         continue
-      grab_job = Job.objects.get(pk=job_data.id, uniqkey=new_uniqkey)
-      logger.debug('NEW:%s' % grab_job.grabbed_until)
-      job = QamasuJob(manager=self, job_data=job_data)
+      logger.debug('NEW:%s' % (server_time + timedelta(seconds=worker.grab_for)))
+      job_data.grabbed_until = server_time + timedelta(seconds=worker.grab_for)
+      # arg was deferred for the candidates, it is read for the grabbed row only.
+      job_data.arg, job_data.payload_id = Job.objects.using(self.using).filter(
+                                            pk=job_data.id).values_list('arg', 'payload_id')[0]
+      job = QamasuJob(manager=self, job_data=job_data, grab_token=grab_token)
+      self._load_data([job])
       return job
     return None
+
+  def _grab_jobs(self, candidates):
+    """
+    Claim every grabbable job of candidates, a list of (id, func_id),
+    stamped with one shared grab token.
+    Rows are updated with a single UPDATE per function because GRAB_FOR
+    depends on the worker module.
+    """
+    ids_by_func = {}
+    for job_id, func_id in candidates:
+      ids_by_func.setdefault(func_id, []).append(job_id)
+    if not ids_by_func:
+      return []
+    server_time = datetime.now()
+    grab_token = uuid().hex
+    for func_id, ids in ids_by_func.items():
+      worker = self.worker(func_id)
+      grabbed = Job.objects.using(self.using).filter(
+                      id__in=ids,
+                      grabbed_until__lte=server_time
+                  ).update(
+                    grab_token=grab_token,
+                    grabbed_until=server_time + timedelta(seconds=worker.grab_for),
+                    dedup_key=None
+                  )
+      if self.instrumentation:
+        self.instrumentation.grab(worker.funcname, len(ids), len(ids) - grabbed)
+    grabbed = dict((job_data.id, job_data) for job_data in
+                   Job.objects.using(self.using).filter(grab_token=grab_token))
+    jobs = [QamasuJob(manager=self, job_data=grabbed[job_id], grab_token=grab_token)
+            for job_id, func_id in candidates if job_id in grabbed]
+    self._load_data(jobs)
+    logger.debug('%d jobs grabbed with token %s.' % (len(jobs), grab_token))
+    return jobs
   
-  def job_failed(self, job, message):
-    error_log = ExceptionLog(func=job.func, message=message, uniqkey=job.uniqkey, arg=job.arg)
-    error_log.save()
+  def retry_or_fail(self, job, exception):
+    """
+    Retry job later with exponential backoff, with a single UPDATE.
+    After max retries, job is moved to ExceptionLog.
+    """
+    logger.debug('Job id:%d failed: %s' % (job.id, exception))
+    worker = self.worker(job.func_id)
+    max_retries = worker.max_retries
+    if max_retries is None:
+      max_retries = self.max_retries
+    if job.retry_cnt < max_retries:
+      retry_seconds = worker.retry_seconds
+      if retry_seconds is None:
+        retry_seconds = self.retry_seconds
+      delay = backoff_seconds(retry_seconds, job.retry_cnt)
+      if self._retry(job, delay):
+        logger.info('Job id:%d will be retried in %.1f seconds.' % (job.id, delay))
+      else:
+        logger.warning('Job id:%d lost its grab. Could be grabbed another worker.' % (job.id,))
+      return
+    self._fail(job, exception)
+    logger.info('Job id:%d failed %d times.' % (job.id, job.retry_cnt + 1))
+
+  def _retry(self, job, delay):
+    # not running anymore, the job is pending again for unique enqueue.
+    return Job.objects.using(self.using).filter(pk=job.id, grab_token=job.grab_token).update(
+             grab_token='',
+             retry_cnt=F('retry_cnt') + 1,
+             grabbed_until=datetime.now() + timedelta(seconds=delay))
+
+  def _fail(self, job, exception):
+    with atomic(using=self.using):
+      self.job_failed(job.org_job, exception, data=job.data)
+      self.dequeue(job)
+
+  def job_failed(self, job, message, data=None):
+    if data is None:
+      data = self._arg_data(job)
+    error_log = ExceptionLog(func_id=job.func_id, message=message, uniqkey=job.uniqkey, arg=data)
+    error_log.save(using=self.using)
   
   def enqueue_failed_job(self, exception_log):
-    return self.enqueue(exception_log.func.name, exception_log.arg, exception_log.uniqkey)
+    return self.enqueue(exception_log.func.name, serializer.loads(exception_log.arg), exception_log.uniqkey)
+
+  def _exception_logs(self, funcs=None, since=None, until=None, message=None):
+    query = ExceptionLog.objects.using(self.using).all()
+    if funcs:
+      query = query.filter(func__name__in=funcs)
+    if since:
+      query = query.filter(exception_time__gte=since)
+    if until:
+      query = query.filter(exception_time__lt=until)
+    if message:
+      query = query.filter(message__contains=message)
+    return query
+
+  def replay_failed_jobs(self, funcs=None, since=None, until=None, message=None,
+                         chunk_size=ENQUEUE_CHUNK_SIZE):
+    """
+    Enqueue the jobs of ExceptionLog matching funcs, exception_time in [since, until)
+    and containing message, and delete their logs.
+    Logs are read by id chunk_size at a time, and each chunk is replayed in its own
+    transaction, so no transaction or result set holds all of them.
+    Returns the number of enqueued jobs.
+    """
+    logs = self._exception_logs(funcs, since, until, message).order_by('id')
+    count = 0
+    last_id = 0
+    while 1:
+      with atomic(using=self.using):
+        chunk = list(logs.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+          break
+        now = datetime.now()
+        Job.objects.using(self.using).bulk_create([Job(func_id=log.func_id, uniqkey=log.uniqkey, enqueue_time=now,
+                                     grabbed_until=now, **self._stored_arg(log.arg))
+                                 for log in chunk])
+        ExceptionLog.objects.using(self.using).filter(id__in=[log.id for log in chunk]).delete()
+      last_id = chunk[-1].id
+      count += len(chunk)
+    if count:
+      self.notifier.notify()
+    logger.info('%d failed jobs replayed.' % count)
+    return count
+
+  def prune_exceptions(self, older_than, funcs=None, chunk_size=PRUNE_CHUNK_SIZE):
+    """
+    Delete ExceptionLog older than older_than seconds, chunk_size rows per transaction
+    so that the table is never locked for long. Returns the number of deleted logs.
+    """
+    query = self._exception_logs(funcs, until=datetime.now() - timedelta(seconds=older_than))
+    count = 0
+    while 1:
+      ids = list(query.order_by('id').values_list('id', flat=True)[:chunk_size])
+      if not ids:
+        break
+      with atomic(using=self.using):
+        ExceptionLog.objects.using(self.using).filter(id__in=ids).delete()
+      count += len(ids)
+    logger.info('%d exception logs pruned.' % count)
+    return count
+
+  def register_func(self, func_name):
+    return Func.objects.using(self.using).get_or_create(name=func_name)[1]
+
+  def schedule(self, name, funcname, arg, interval, start_at=None):
+    """
+    Enqueue a job of arg every interval seconds from start_at(now by default).
+    A schedule of the same name is replaced.
+    """
+    Schedule.objects.using(self.using).filter(name=name).delete()
+    schedule = Schedule(name=name, func_id=self._func_id(funcname), arg=serializer.dumps(arg),
+                        interval=interval, next_run_at=start_at or datetime.now())
+    schedule.save(using=self.using)
+    return schedule
+
+  def unschedule(self, name):
+    Schedule.objects.using(self.using).filter(name=name).delete()
+
+  def materialize_schedules(self):
+    """
+    Enqueue the job of every due schedule of abilities, once even if runs were missed.
+    Each run is enqueued by only one worker.
+    """
+    now = datetime.now()
+    count = 0
+    for schedule in Schedule.objects.using(self.using).filter(func__in=self._ability_func_ids(), next_run_at__lte=now):
+      interval = timedelta(seconds=schedule.interval)
+      next_run_at = schedule.next_run_at + interval
+      if next_run_at <= now:
+        missed = int(total_seconds(now - next_run_at) // schedule.interval) + 1
+        next_run_at += interval * missed
+      with atomic(using=self.using):
+        claimed = Schedule.objects.using(self.using).filter(pk=schedule.pk, next_run_at=schedule.next_run_at).update(
+                    next_run_at=next_run_at)
+        if claimed:
+          self.enqueue(self.worker(schedule.func_id).funcname, serializer.loads(schedule.arg),
+                       uuid().hex, run_at=schedule.next_run_at)
+          count += 1
+    if count:
+      logger.debug('%d scheduled jobs enqueued.' % count)
+    return count
+
+  def purge(self):
+    Job.objects.using(self.using).all().delete()
+    Payload.objects.using(self.using).all().delete()
+
+  def job_count(self, funcs=None):
+    query = Job.objects.using(self.using).all()
+    if funcs:
+      query = query.filter(func__name__in=funcs)
+    return query.count()
+
+  def stats(self, max_age=STATS_MAX_AGE):
+    updated_at = QueueStat.objects.using(self.using).aggregate(Max('updated_at'))['updated_at__max']
+    if updated_at is None or updated_at < datetime.now() - timedelta(seconds=max_age):
+      self.refresh_stats()
+    result = {}
+    for stat in QueueStat.objects.using(self.using).select_related('func'):
+      result[stat.func.name] = dict(ready=stat.ready, leased=stat.leased, delayed=stat.delayed,
+                                    oldest_enqueue_time=stat.oldest_enqueue_time)
+    return result
+
+  def refresh_stats(self):
+    now = datetime.now()
+    stats = dict((func_id, QueueStat(func_id=func_id, updated_at=now))
+                 for func_id in Func.objects.using(self.using).values_list('id', flat=True))
+    def aggregate(query, field):
+      for row in query.values('func').annotate(count=Count('id'), oldest=Min('enqueue_time')):
+        stat = stats[row['func']]
+        setattr(stat, field, row['count'])
+        if stat.oldest_enqueue_time is None or row['oldest'] < stat.oldest_enqueue_time:
+          stat.oldest_enqueue_time = row['oldest']
+    aggregate(Job.objects.using(self.using).filter(grabbed_until__lte=now), 'ready')
+    aggregate(Job.objects.using(self.using).filter(grabbed_until__gt=now).exclude(grab_token=''), 'leased')
+    aggregate(Job.objects.using(self.using).filter(grabbed_until__gt=now, grab_token=''), 'delayed')
+    # upsert per func, as workers refresh concurrently.
+    for stat in stats.values():
+      fields = dict(ready=stat.ready, leased=stat.leased, delayed=stat.delayed,
+                    oldest_enqueue_time=stat.oldest_enqueue_time, updated_at=stat.updated_at)
+      query = QueueStat.objects.using(self.using).filter(func=stat.func_id)
+      if query.update(**fields):
+        continue
+      try:
+        with atomic(using=self.using):
+          stat.save(using=self.using, force_insert=True)
+      except IntegrityError:
+        # inserted by another worker meanwhile.
+        query.update(**fields)
 
 class Qamasu(object):
   """
@@ -193,9 +1454,18 @@ class Qamasu(object):
   True
   >>> qamasu.work()
   """
-  def __init__(self, manager_abilities, find_job_limit_size=FIND_JOB_LIMIT_SIZE, retry_seconds=RETRY_SECONDS):
+  def __init__(self, manager_abilities, find_job_limit_size=FIND_JOB_LIMIT_SIZE, retry_seconds=RETRY_SECONDS,
+               grab_strategy=None, notifier=None, max_retries=MAX_RETRIES, instrumentation=None,
+               manager_class=None, manager_options=None, scheduler=None):
     self.find_job_limit_size = find_job_limit_size
+    self.scheduler = scheduler
+    self.manager_class = manager_class or Manager
+    self.manager_options = manager_options or {}
     self.retry_seconds = retry_seconds
+    self.max_retries = max_retries
+    self.instrumentation = instrumentation
+    self.grab_strategy = grab_strategy
+    self.notifier = notifier
     self._manager = None
     self.manager_abilities = manager_abilities
     self.gentle_terminate = False
@@ -204,28 +1474,148 @@ class Qamasu(object):
   @property
   def manager(self):
     if not self._manager:
-      self._manager = Manager(find_job_limit_size=self.find_job_limit_size,
-                              retry_seconds=self.retry_seconds,
-                              abilities=self.manager_abilities)
+      self._manager = self.manager_class(find_job_limit_size=self.find_job_limit_size,
+                                         retry_seconds=self.retry_seconds,
+                                         abilities=self.manager_abilities,
+                                         grab_strategy=self.grab_strategy,
+                                         notifier=self.notifier,
+                                         max_retries=self.max_retries,
+                                         instrumentation=self.instrumentation,
+                                         scheduler=self.scheduler,
+                                         **self.manager_options)
     return self._manager
   
-  def enqueue(self, funcname, arg, uniqkey=None, priority=None):
+  def enqueue(self, funcname, arg, uniqkey=None, priority=None, unique=False, run_at=None, delay=None):
     if not uniqkey:
       uniqkey = uuid().hex
-    self.manager.enqueue(funcname, arg, uniqkey, priority=priority)
+    self.manager.enqueue(funcname, arg, uniqkey, priority=priority, unique=unique,
+                         run_at=run_at, delay=delay)
+
+  def enqueue_many(self, funcname, args, priority=None, chunk_size=ENQUEUE_CHUNK_SIZE,
+                   uniqkey=None, unique=False, run_at=None, delay=None):
+    return self.manager.enqueue_many(funcname, args, priority=priority, chunk_size=chunk_size,
+                                     uniqkey=uniqkey, unique=unique, run_at=run_at, delay=delay)
+
+  def schedule(self, name, funcname, arg, interval, start_at=None):
+    return self.manager.schedule(name, funcname, arg, interval, start_at=start_at)
+
+  def unschedule(self, name):
+    self.manager.unschedule(name)
   
-  @transaction.autocommit
-  def work(self, work_delay=5, prioritizing=False):
+  @autocommit
+  def work(self, work_delay=5, prioritizing=False, batch_size=1, max_jobs=None, concurrency=1):
     if not self.manager.has_abilities():
       logger.error('manager dose not have abilities.')
       import sys
       sys.exit(-1)
-    while 1:
-      if self.gentle_terminate:
-        logger.info('gentle terminate')
-        break
-      if not self.manager.work_once(prioritizing=prioritizing):
-        time.sleep(work_delay)
+    notifier = self.manager.notifier
+    notifier.start()
+    processed = 0
+    schedule_checked = 0
+    try:
+      while 1:
+        if self.gentle_terminate:
+          logger.info('gentle terminate')
+          break
+        if max_jobs and processed >= max_jobs:
+          logger.info('processed %d jobs' % processed)
+          break
+        if time.time() - schedule_checked >= SCHEDULE_CHECK_SECONDS:
+          self.manager.materialize_schedules()
+          schedule_checked = time.time()
+        self.manager.flush(force=False)
+        if concurrency > 1:
+          worked = self.manager.work_concurrently(concurrency, prioritizing=prioritizing)
+        else:
+          worked = self.manager.work_batch(batch_size, prioritizing=prioritizing)
+        if worked:
+          processed += worked
+          notifier.reset()
+        else:
+          # the queue is empty, completed jobs are not kept while waiting.
+          self.manager.flush()
+          notifier.wait(work_delay)
+    finally:
+      notifier.close()
+      self.manager.close()
+    return processed
+
+  def work_pool(self, processes=4, max_jobs=None, work_delay=5, prioritizing=False, batch_size=1,
+                concurrency=1, restart_seconds=RESTART_SECONDS):
+    '''
+    Fork processes workers and restart them when they exit.
+    A worker exits after max_jobs jobs to cap its memory growth.
+    A worker is restarted restart_seconds after the start of the last one at the earliest,
+    so workers crashing at once(database down, import error) are not forked in a tight loop.
+    SIGTERM(handle_terminate) terminates all workers gently.
+    '''
+    if not self.manager.has_abilities():
+      logger.error('manager dose not have abilities.')
+      import sys
+      sys.exit(-1)
+    close_connections()
+    children = {}
+    restarts = []
+    previous_handler = signal.signal(signal.SIGTERM, self.handle_terminate)
+    try:
+      while 1:
+        while not self.gentle_terminate and len(children) < processes:
+          if restarts:
+            delay = restarts.pop(0) - time.time()
+            if delay > 0:
+              logger.info('restart a worker in %.1f seconds.' % delay)
+              time.sleep(delay)
+              if self.gentle_terminate:
+                break
+          pid = os.fork()
+          if not pid:
+            self._work_child(max_jobs, work_delay, prioritizing, batch_size, concurrency)
+          logger.info('worker(%d) started.' % pid)
+          children[pid] = time.time()
+        if self.gentle_terminate:
+          break
+        try:
+          pid, status = os.wait()
+        except OSError, e:
+          if e.errno == errno.EINTR:
+            continue
+          raise
+        started = children.pop(pid, None)
+        if started is not None:
+          restarts.append(started + restart_seconds)
+          restarts.sort()
+        logger.info('worker(%d) exited with status %d.' % (pid, status))
+      logger.info('gentle terminate %d workers' % len(children))
+      for pid in children:
+        try:
+          os.kill(pid, signal.SIGTERM)
+        except OSError:
+          pass
+      while children:
+        try:
+          pid, status = os.wait()
+        except OSError, e:
+          if e.errno == errno.EINTR:
+            continue
+          if e.errno == errno.ECHILD:
+            break
+          raise
+        children.pop(pid, None)
+    finally:
+      signal.signal(signal.SIGTERM, previous_handler)
+
+  def _work_child(self, max_jobs, work_delay, prioritizing, batch_size, concurrency):
+    status = 0
+    try:
+      signal.signal(signal.SIGTERM, self.handle_terminate)
+      self._manager = None
+      self.work(work_delay=work_delay, prioritizing=prioritizing,
+                batch_size=batch_size, max_jobs=max_jobs, concurrency=concurrency)
+    except:
+      logger.exception('worker(%d) crashed.' % os.getpid())
+      status = 1
+    close_connections()
+    os._exit(status)
 
   def handle_terminate(self, *args):
     '''
@@ -252,11 +1642,11 @@ class Qamasu(object):
     logger.info('preparing gentle terminate')
     self.gentle_terminate = True
   
-  def work_prioritizing(self, work_delay=5):
-    self.work(work_delay=work_delay, prioritizing=True)
+  def work_prioritizing(self, work_delay=5, batch_size=1):
+    self.work(work_delay=work_delay, prioritizing=True, batch_size=batch_size)
   
   def purge(self):
-    Job.objects.all().delete()
+    self.manager.purge()
   
   def job_list(self, funcs=None):
     query = Job.objects.all().order_by('id')
@@ -265,20 +1655,36 @@ class Qamasu(object):
     return query.filter(grabbed_until__lte=datetime.now())[:self.find_job_limit_size]
   
   def job_count(self, funcs=None):
-    query = Job.objects.all()
-    if funcs:
-      query = query.filter(func__name__in=funcs)
-    return query.count()
+    return self.manager.job_count(funcs=funcs)
+
+  def stats(self, max_age=STATS_MAX_AGE):
+    """
+    Returns a dict of function name to the number of ready, leased and
+    delayed(waiting for retry or coalescing) jobs and the oldest enqueue_time.
+    Numbers are cached in QueueStat and at most max_age seconds old.
+    """
+    return self.manager.stats(max_age=max_age)
+
+  def refresh_stats(self):
+    self.manager.refresh_stats()
   
   def exception_list(self, funcs=None):
     query = ExceptionLog.objects.all()
     if funcs:
       query = query.filter(func__name__in=funcs)
     return query
+
+  def replay_failed_jobs(self, funcs=None, since=None, until=None, message=None,
+                         chunk_size=ENQUEUE_CHUNK_SIZE):
+    return self.manager.replay_failed_jobs(funcs=funcs, since=since, until=until, message=message,
+                                           chunk_size=chunk_size)
+
+  def prune_exceptions(self, older_than, funcs=None, chunk_size=PRUNE_CHUNK_SIZE):
+    return self.manager.prune_exceptions(older_than, funcs=funcs, chunk_size=chunk_size)
   
   def func_list(self):
     return Func.objects.all().order_by('id')
   
   def register_func(self, func_name):
-    return Func.objects.get_or_create(name=func_name)[1]
+    return self.manager.register_func(func_name)
 
@@ -0,0 +1,317 @@
+"""
+Benchmarks for Qamasu.
+
+Run against the database configured in DJANGO_SETTINGS_MODULE.
+Jobs and functions created here are purged afterwards, so never run it
+against a production database.
+::
+
+    $ DJANGO_SETTINGS_MODULE=qamasu_test.settings python -m qamasu.benchmark contention
+    $ DJANGO_SETTINGS_MODULE=qamasu_test.settings python -m qamasu.benchmark backlog
+    $ DJANGO_SETTINGS_MODULE=qamasu_test.settings python -m qamasu.benchmark suite
+
+This module is also the worker module of the benchmark jobs.
+"""
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+try:
+  from django.utils import timezone as datetime
+except ImportError:
+  from datetime import datetime
+import sys
+import threading
+import time
+
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+
+from qamasu import Qamasu, OptimisticGrabStrategy, SkipLockedGrabStrategy, BackoffNotifier, default_grab_strategy
+from qamasu import supports_skip_locked
+from qamasu.models import Func
+
+BENCHMARK_FUNC = 'qamasu.benchmark'
+WORKER_COUNTS = (1, 2, 4, 8, 16, 32, 64)
+BACKLOG_SIZES = (1000, 10000)
+PAYLOAD_SIZES = (10, 1000)
+SUITE_WORKER_COUNTS = (1, 4)
+
+GRAB_FOR = 60
+
+_pickup_latencies = []
+_pickup_lock = threading.Lock()
+
+
+def work_safely(manager, job):
+  latency = datetime.now() - job.org_job.enqueue_time
+  _pickup_lock.acquire()
+  try:
+    _pickup_latencies.append(latency.seconds + latency.microseconds / 1000000.0)
+  finally:
+    _pickup_lock.release()
+  job.complete()
+
+
+class QueryCounter(object):
+  """
+  Count queries run on the connection of the current thread, with or without DEBUG.
+  count is None when more queries ran than the connection logs(queries_limit of Django 1.8).
+  """
+  def __enter__(self):
+    reset_queries()
+    self._context = CaptureQueriesContext(connection)
+    self._context.__enter__()
+    return self
+
+  def __exit__(self, *exc_info):
+    self._context.__exit__(*exc_info)
+    limit = getattr(connection, 'queries_limit', None)
+    if limit is not None and self._context.final_queries >= limit:
+      self.count = None
+    else:
+      self.count = len(self._context)
+
+
+def _per_job(count, jobs):
+  if count is None or not jobs:
+    return None
+  return float(count) / jobs
+
+
+def percentile(values, percent):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def _grab_until_empty(qamasu, counter, lock):
+  grabbed = 0
+  try:
+    while 1:
+      job = qamasu.manager.find_job()
+      if not job:
+        break
+      job.complete()
+      grabbed += 1
+  finally:
+    connection.close()
+  lock.acquire()
+  try:
+    counter.append(grabbed)
+  finally:
+    lock.release()
+
+
+def grab_contention(worker_counts=WORKER_COUNTS, job_count=2000, grab_strategy=None):
+  """
+  Enqueue job_count jobs and drain them with each number of workers in
+  worker_counts. Returns a list of (workers, jobs/sec).
+  """
+  if grab_strategy is None:
+    grab_strategy = default_grab_strategy()
+  qamasu = Qamasu([BENCHMARK_FUNC], grab_strategy=grab_strategy)
+  qamasu.register_func(BENCHMARK_FUNC)
+  results = []
+  try:
+    for workers in worker_counts:
+      qamasu.purge()
+      for x in xrange(job_count):
+        qamasu.enqueue(BENCHMARK_FUNC, dict(number=x))
+      counter = []
+      lock = threading.Lock()
+      threads = [threading.Thread(target=_grab_until_empty,
+                                  args=(Qamasu([BENCHMARK_FUNC], grab_strategy=grab_strategy), counter, lock))
+                 for x in xrange(workers)]
+      started = time.time()
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      elapsed = time.time() - started
+      results.append((workers, sum(counter) / elapsed))
+  finally:
+    qamasu.purge()
+    Func.objects.filter(name=BENCHMARK_FUNC).delete()
+  return results
+
+
+def find_job_backlog(backlog=1000000, polls=200):
+  """
+  Enqueue backlog jobs and time find_job with both orderings.
+  Returns a dict of ordering to milliseconds per find_job.
+  """
+  qamasu = Qamasu([BENCHMARK_FUNC])
+  qamasu.register_func(BENCHMARK_FUNC)
+  results = {}
+  try:
+    qamasu.purge()
+    qamasu.enqueue_many(BENCHMARK_FUNC, (dict(number=x) for x in xrange(backlog)))
+    for prioritizing in (False, True):
+      started = time.time()
+      for x in xrange(polls):
+        job = qamasu.manager.find_job(prioritizing=prioritizing)
+        job.complete()
+      results[prioritizing and 'priority' or 'fifo'] = (time.time() - started) * 1000 / polls
+  finally:
+    qamasu.purge()
+    Func.objects.filter(name=BENCHMARK_FUNC).delete()
+  return results
+
+
+def _payload(number, payload_size):
+  return dict(number=number, payload='x' * payload_size)
+
+
+def _measure(func, count):
+  started = time.time()
+  counter = QueryCounter()
+  counter.__enter__()
+  try:
+    func()
+  finally:
+    counter.__exit__(None, None, None)
+  elapsed = time.time() - started
+  return {
+    'jobs_per_sec': count / elapsed,
+    'queries_per_job': _per_job(counter.count, count),
+  }
+
+
+def _work(qamasu, max_jobs, results, lock):
+  counter = QueryCounter()
+  try:
+    counter.__enter__()
+    try:
+      processed = qamasu.work(work_delay=0.5, max_jobs=max_jobs)
+    finally:
+      counter.__exit__(None, None, None)
+  finally:
+    connection.close()
+  lock.acquire()
+  try:
+    results.append((processed, counter.count))
+  finally:
+    lock.release()
+
+
+def end_to_end(job_count, workers, payload_size):
+  """
+  Enqueue job_count jobs one by one while workers threads run Qamasu.work on them.
+  Returns jobs/sec, queries per job of the workers(polling included)
+  and pickup latency, the time from enqueue to grab.
+  """
+  del _pickup_latencies[:]
+  results = []
+  lock = threading.Lock()
+  workers = [Qamasu([BENCHMARK_FUNC], notifier=BackoffNotifier(min_delay=0.01)) for x in xrange(workers)]
+  threads = [threading.Thread(target=_work, args=(worker, job_count, results, lock)) for worker in workers]
+  qamasu = Qamasu([BENCHMARK_FUNC])
+  started = time.time()
+  for thread in threads:
+    thread.start()
+  try:
+    for x in xrange(job_count):
+      qamasu.enqueue(BENCHMARK_FUNC, _payload(x, payload_size))
+    while qamasu.job_count(funcs=[BENCHMARK_FUNC]):
+      time.sleep(0.01)
+    elapsed = time.time() - started
+  finally:
+    for worker in workers:
+      worker.handle_terminate()
+    for thread in threads:
+      thread.join()
+  processed = sum(worked for worked, count in results)
+  counts = [count for worked, count in results]
+  queries = None
+  if None not in counts:
+    queries = sum(counts)
+  return {
+    'jobs_per_sec': processed / elapsed,
+    'queries_per_job': _per_job(queries, processed),
+    'pickup_latency_p50': percentile(_pickup_latencies, 50),
+    'pickup_latency_p99': percentile(_pickup_latencies, 99),
+  }
+
+
+def suite(backlog_sizes=BACKLOG_SIZES, worker_counts=SUITE_WORKER_COUNTS, payload_sizes=PAYLOAD_SIZES,
+          job_count=1000):
+  """
+  Measure enqueue, find_job, complete and end-to-end work.
+  Returns a list of dicts, one per scenario, ready to dump as JSON.
+  """
+  qamasu = Qamasu([BENCHMARK_FUNC])
+  qamasu.register_func(BENCHMARK_FUNC)
+  results = []
+  try:
+    for payload_size in payload_sizes:
+      for backlog in backlog_sizes:
+        qamasu.purge()
+        qamasu.enqueue_many(BENCHMARK_FUNC, (_payload(x, payload_size) for x in xrange(backlog)))
+        scenario = dict(vendor=connection.vendor, backlog=backlog, payload_size=payload_size)
+
+        def enqueue():
+          for x in xrange(job_count):
+            qamasu.enqueue(BENCHMARK_FUNC, _payload(x, payload_size))
+        results.append(dict(scenario, operation='enqueue', **_measure(enqueue, job_count)))
+
+        jobs = []
+        def find_job():
+          for x in xrange(job_count):
+            job = qamasu.manager.find_job()
+            if job:
+              jobs.append(job)
+        results.append(dict(scenario, operation='find_job', **_measure(find_job, job_count)))
+
+        def complete():
+          for job in jobs:
+            job.complete()
+        results.append(dict(scenario, operation='complete', **_measure(complete, job_count)))
+
+      for workers in worker_counts:
+        qamasu.purge()
+        results.append(dict(vendor=connection.vendor, backlog=0, payload_size=payload_size,
+                            operation='work', workers=workers,
+                            **end_to_end(job_count, workers, payload_size)))
+  finally:
+    qamasu.purge()
+    Func.objects.filter(name=BENCHMARK_FUNC).delete()
+  return results
+
+
+def run_suite():
+  print json.dumps(suite(), indent=2)
+
+
+def run_contention():
+  strategies = [OptimisticGrabStrategy()]
+  if supports_skip_locked():
+    strategies.append(SkipLockedGrabStrategy())
+  for strategy in strategies:
+    print strategy.__class__.__name__
+    for workers, jobs_per_sec in grab_contention(grab_strategy=strategy):
+      print '%3d workers: %10.1f jobs/sec' % (workers, jobs_per_sec)
+
+
+def run_backlog():
+  for ordering, msec in sorted(find_job_backlog().items()):
+    print '%8s: %8.3f msec/find_job' % (ordering, msec)
+
+
+BENCHMARKS = {
+  'contention': run_contention,
+  'backlog': run_backlog,
+  'suite': run_suite,
+}
+
+
+def main(argv):
+  names = argv[1:] or sorted(BENCHMARKS.keys())
+  for name in names:
+    BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,44 @@
+try:
+  import json
+except ImportError:
+  import simplejson as json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from qamasu import benchmark
+
+
+def _int_list(value):
+  return [int(v) for v in value.split(',')]
+
+
+class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+    make_option('--backlog', dest='backlog', default=','.join(map(str, benchmark.BACKLOG_SIZES)),
+                help='Comma separated backlog sizes.'),
+    make_option('--workers', dest='workers', default=','.join(map(str, benchmark.SUITE_WORKER_COUNTS)),
+                help='Comma separated worker counts.'),
+    make_option('--payload', dest='payload', default=','.join(map(str, benchmark.PAYLOAD_SIZES)),
+                help='Comma separated payload sizes in bytes.'),
+    make_option('--jobs', type='int', dest='jobs', default=1000,
+                help='Number of jobs measured in each scenario.'),
+    make_option('--output', dest='output', default=None,
+                help='Write JSON to this file instead of stdout.'),
+  )
+  help = 'Benchmark enqueue, find_job, complete and work. All jobs are purged!'
+
+  def handle(self, *args, **options):
+    results = benchmark.suite(backlog_sizes=_int_list(options['backlog']),
+                              worker_counts=_int_list(options['workers']),
+                              payload_sizes=_int_list(options['payload']),
+                              job_count=options['jobs'])
+    output = json.dumps(results, indent=2)
+    if options['output']:
+      f = open(options['output'], 'w')
+      try:
+        f.write(output)
+      finally:
+        f.close()
+    else:
+      self.stdout.write(output + '\n')
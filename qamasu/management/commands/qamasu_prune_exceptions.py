@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from qamasu import Qamasu, PRUNE_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+    make_option('--days', type='float', dest='days', default=None,
+                help='Delete exception logs older than this many days.'),
+    make_option('--chunk-size', type='int', dest='chunk_size', default=PRUNE_CHUNK_SIZE,
+                help='Number of logs deleted per transaction.'),
+  )
+  help = 'Delete old exception logs in chunks, of the given functions or of all.'
+  args = '<function function ...>'
+
+  def handle(self, *funcs, **options):
+    if options['days'] is None:
+      raise CommandError('Specify --days.')
+    qamasu = Qamasu([])
+    count = qamasu.prune_exceptions(options['days'] * 86400, funcs=list(funcs),
+                                    chunk_size=options['chunk_size'])
+    self.stdout.write('%d exception logs deleted.\n' % count)
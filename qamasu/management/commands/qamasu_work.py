@@ -0,0 +1,39 @@
+import signal
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from qamasu import Qamasu
+
+
+class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+    make_option('--processes', type='int', dest='processes', default=1,
+                help='Number of worker processes.'),
+    make_option('--max-jobs', type='int', dest='max_jobs', default=None,
+                help='Restart a worker process after it processed this many jobs.'),
+    make_option('--delay', type='float', dest='work_delay', default=5,
+                help='Max seconds to wait for a job when the queue is empty.'),
+    make_option('--batch-size', type='int', dest='batch_size', default=1,
+                help='Number of jobs grabbed at once.'),
+    make_option('--concurrency', type='int', dest='concurrency', default=1,
+                help='Number of jobs run at once in each worker process.'),
+    make_option('--prioritizing', action='store_true', dest='prioritizing', default=False,
+                help='Process jobs respecting priority.'),
+  )
+  help = 'Process enqueued jobs with the given worker modules.'
+  args = '<worker module worker module ...>'
+
+  def handle(self, *abilities, **options):
+    if not abilities:
+      raise CommandError('Specify at least one worker module.')
+    qamasu = Qamasu(list(abilities))
+    if options['processes'] > 1:
+      qamasu.work_pool(processes=options['processes'], max_jobs=options['max_jobs'],
+                       work_delay=options['work_delay'], prioritizing=options['prioritizing'],
+                       batch_size=options['batch_size'], concurrency=options['concurrency'])
+    else:
+      signal.signal(signal.SIGTERM, qamasu.handle_terminate)
+      qamasu.work(work_delay=options['work_delay'], prioritizing=options['prioritizing'],
+                  batch_size=options['batch_size'], max_jobs=options['max_jobs'],
+                  concurrency=options['concurrency'])
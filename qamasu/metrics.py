@@ -0,0 +1,194 @@
+"""
+Instrumentation of Manager.
+
+Manager calls the hooks of its instrumentation when it is given one.
+Without instrumentation, the hooks are not called at all.
+::
+
+    >>> from qamasu import Qamasu, Metrics
+    >>> metrics = Metrics()
+    >>> qamasu = Qamasu(['workers.random_wait',], instrumentation=metrics)
+    >>> metrics.serve(9100)
+    >>> qamasu.work()
+"""
+import os
+import socket
+import threading
+
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class Instrumentation(object):
+  """
+  Hooks called by Manager. Override the ones you need.
+  """
+  def find_job(self, seconds, found):
+    pass
+
+  def grab(self, funcname, attempts, misses):
+    pass
+
+  def job_started(self, funcname, wait_seconds):
+    pass
+
+  def job_finished(self, funcname, seconds, failed):
+    pass
+
+
+class Metrics(Instrumentation):
+  """
+  Collect counters and summaries, and export them in the Prometheus
+  text format or as StatsD lines.
+  """
+  COUNTERS = (
+    ('grab_attempts_total', 'Number of attempts to grab a job.'),
+    ('grab_misses_total', 'Number of jobs grabbed by another worker first.'),
+    ('jobs_total', 'Number of processed jobs.'),
+    ('job_failures_total', 'Number of failed jobs.'),
+  )
+  SUMMARIES = (
+    ('find_job_seconds', 'Time to find and grab jobs.'),
+    ('queue_wait_seconds', 'Time from enqueue to start of work.'),
+    ('job_duration_seconds', 'Time spent in work_safely.'),
+  )
+
+  def __init__(self, prefix='qamasu'):
+    self.prefix = prefix
+    self._lock = threading.Lock()
+    self.counters = dict((name, {}) for name, help in self.COUNTERS)
+    self.summaries = dict((name, {}) for name, help in self.SUMMARIES)
+
+  def _inc(self, name, funcname, value=1):
+    counter = self.counters[name]
+    counter[funcname] = counter.get(funcname, 0) + value
+
+  def _observe(self, name, funcname, value):
+    total, count = self.summaries[name].get(funcname, (0.0, 0))
+    self.summaries[name][funcname] = (total + value, count + 1)
+
+  def find_job(self, seconds, found):
+    self._lock.acquire()
+    try:
+      self._observe('find_job_seconds', None, seconds)
+    finally:
+      self._lock.release()
+
+  def grab(self, funcname, attempts, misses):
+    self._lock.acquire()
+    try:
+      self._inc('grab_attempts_total', funcname, attempts)
+      self._inc('grab_misses_total', funcname, misses)
+    finally:
+      self._lock.release()
+
+  def job_started(self, funcname, wait_seconds):
+    self._lock.acquire()
+    try:
+      self._observe('queue_wait_seconds', funcname, wait_seconds)
+    finally:
+      self._lock.release()
+
+  def job_finished(self, funcname, seconds, failed):
+    self._lock.acquire()
+    try:
+      self._inc('jobs_total', funcname)
+      if failed:
+        self._inc('job_failures_total', funcname)
+      self._observe('job_duration_seconds', funcname, seconds)
+    finally:
+      self._lock.release()
+
+  def _labels(self, funcname):
+    if funcname is None:
+      return ''
+    return '{func="%s"}' % funcname.replace('\\', '\\\\').replace('"', '\\"')
+
+  def prometheus_text(self):
+    self._lock.acquire()
+    try:
+      lines = []
+      for name, help in self.COUNTERS:
+        metric = '%s_%s' % (self.prefix, name)
+        lines.append('# HELP %s %s' % (metric, help))
+        lines.append('# TYPE %s counter' % metric)
+        for funcname, value in sorted(self.counters[name].items()):
+          lines.append('%s%s %d' % (metric, self._labels(funcname), value))
+      for name, help in self.SUMMARIES:
+        metric = '%s_%s' % (self.prefix, name)
+        lines.append('# HELP %s %s' % (metric, help))
+        lines.append('# TYPE %s summary' % metric)
+        for funcname, (total, count) in sorted(self.summaries[name].items()):
+          lines.append('%s_sum%s %f' % (metric, self._labels(funcname), total))
+          lines.append('%s_count%s %d' % (metric, self._labels(funcname), count))
+      return '\n'.join(lines) + '\n'
+    finally:
+      self._lock.release()
+
+  def statsd_lines(self):
+    """
+    Counters as StatsD gauges of their running totals, summaries as mean timings in ms.
+    """
+    self._lock.acquire()
+    try:
+      lines = []
+      for name, help in self.COUNTERS:
+        for funcname, value in sorted(self.counters[name].items()):
+          lines.append('%s:%d|g' % (self._statsd_name(name, funcname), value))
+      for name, help in self.SUMMARIES:
+        for funcname, (total, count) in sorted(self.summaries[name].items()):
+          lines.append('%s:%f|ms' % (self._statsd_name(name, funcname), total * 1000 / count))
+      return lines
+    finally:
+      self._lock.release()
+
+  def _statsd_name(self, name, funcname):
+    if funcname is None:
+      return '%s.%s' % (self.prefix, name)
+    return '%s.%s.%s' % (self.prefix, funcname.replace('.', '_'), name)
+
+  def send_statsd(self, host='localhost', port=8125):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      for line in self.statsd_lines():
+        sock.sendto(line.encode('utf-8'), (host, port))
+    finally:
+      sock.close()
+
+  def write(self, path):
+    """
+    Write the Prometheus text to path, e.g. for node_exporter's textfile collector.
+    """
+    tmp_path = '%s.tmp' % path
+    f = open(tmp_path, 'w')
+    try:
+      f.write(self.prometheus_text())
+    finally:
+      f.close()
+    os.rename(tmp_path, path)
+
+  def serve(self, port, host='127.0.0.1'):
+    """
+    Serve the Prometheus text on http://host:port/ in a daemon thread.
+    """
+    metrics = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        body = metrics.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, *args):
+        pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
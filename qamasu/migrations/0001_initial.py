@@ -0,0 +1,42 @@
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Func',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=50, db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('arg', models.TextField(blank=True)),
+                ('uniqkey', models.CharField(max_length=32, db_index=True)),
+                ('enqueue_time', models.DateTimeField(editable=False, blank=True, db_index=True)),
+                ('grabbed_until', models.DateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+                ('retry_cnt', models.PositiveSmallIntegerField(default=0, blank=True)),
+                ('priority', models.PositiveSmallIntegerField(default=5, blank=True)),
+                ('func', models.ForeignKey(to='qamasu.Func')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ExceptionLog',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('message', models.TextField(blank=True)),
+                ('arg', models.TextField(blank=True)),
+                ('exception_time', models.DateTimeField(blank=True)),
+                ('uniqkey', models.CharField(max_length=32)),
+                ('func', models.ForeignKey(to='qamasu.Func')),
+            ],
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qamasu', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='job',
+            index_together=set([('func', 'grabbed_until', 'id'), ('func', 'grabbed_until', 'priority', 'id')]),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qamasu', '0002_job_ready_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('ready', models.PositiveIntegerField(default=0)),
+                ('leased', models.PositiveIntegerField(default=0)),
+                ('delayed', models.PositiveIntegerField(default=0)),
+                ('oldest_enqueue_time', models.DateTimeField(null=True, blank=True)),
+                ('updated_at', models.DateTimeField(db_index=True)),
+                ('func', models.ForeignKey(to='qamasu.Func', unique=True)),
+            ],
+        ),
+    ]
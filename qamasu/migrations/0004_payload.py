@@ -0,0 +1,23 @@
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qamasu', '0003_queuestat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Payload',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('data', models.TextField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='payload_id',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+    ]
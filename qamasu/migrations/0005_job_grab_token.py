@@ -0,0 +1,16 @@
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qamasu', '0004_payload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='grab_token',
+            field=models.CharField(default='', max_length=32, db_index=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qamasu', '0005_job_grab_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Schedule',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=100)),
+                ('arg', models.TextField(blank=True)),
+                ('interval', models.PositiveIntegerField()),
+                ('next_run_at', models.DateTimeField(db_index=True)),
+                ('func', models.ForeignKey(to='qamasu.Func')),
+            ],
+        ),
+    ]
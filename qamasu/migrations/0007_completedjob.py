@@ -0,0 +1,23 @@
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qamasu', '0006_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletedJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('job_id', models.PositiveIntegerField()),
+                ('uniqkey', models.CharField(max_length=32)),
+                ('enqueue_time', models.DateTimeField()),
+                ('completed_at', models.DateTimeField(db_index=True)),
+                ('retry_cnt', models.PositiveSmallIntegerField(default=0)),
+                ('func', models.ForeignKey(to='qamasu.Func')),
+            ],
+        ),
+    ]
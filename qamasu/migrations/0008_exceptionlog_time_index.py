@@ -0,0 +1,16 @@
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qamasu', '0007_completedjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exceptionlog',
+            name='exception_time',
+            field=models.DateTimeField(blank=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qamasu', '0008_exceptionlog_time_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='job',
+            index_together=set([('func', 'id'), ('func', 'priority', 'id')]),
+        ),
+    ]
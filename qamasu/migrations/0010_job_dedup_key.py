@@ -0,0 +1,20 @@
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qamasu', '0009_job_ready_order_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='dedup_key',
+            field=models.CharField(max_length=32, null=True, editable=False, blank=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='job',
+            unique_together=set([('func', 'dedup_key')]),
+        ),
+    ]
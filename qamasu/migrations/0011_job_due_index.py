@@ -0,0 +1,15 @@
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qamasu', '0010_job_dedup_key'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='job',
+            index_together=set([('func', 'grabbed_until'), ('func', 'priority', 'id')]),
+        ),
+    ]
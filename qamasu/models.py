@@ -16,26 +16,83 @@ class Job(models.Model):
   func = models.ForeignKey(Func)
   arg = models.TextField(blank=True)
   uniqkey = models.CharField(max_length=32, db_index=True)
+  # set by the worker grabbing the job, uniqkey stays the one given to enqueue.
+  grab_token = models.CharField(max_length=32, blank=True, default='', db_index=True)
+  # uniqkey of a job enqueued with unique=True until it is grabbed, NULL otherwise.
+  dedup_key = models.CharField(max_length=32, null=True, blank=True, editable=False)
   enqueue_time = models.DateTimeField(editable=False, blank=True, db_index=True)
-  grabbed_until = models.DateTimeField(editable=False, blank=True, default=0)
+  grabbed_until = models.DateTimeField(editable=False, blank=True, default=datetime.now)
   retry_cnt = models.PositiveSmallIntegerField(blank=True, default=0)
   priority = models.PositiveSmallIntegerField(blank=True, default=5)
+  # id of the Payload holding a large arg, arg is empty then.
+  payload_id = models.PositiveIntegerField(null=True, blank=True)
+
+  class Meta:
+    # (func, grabbed_until) finds the few ready jobs of a function among delayed ones.
+    # A backlog is read in find_job order, FIFO on the index of func(ids follow on
+    # SQLite and MySQL) and prioritizing on (func, priority, id), without sorting it.
+    index_together = [
+      ('func', 'grabbed_until'),
+      ('func', 'priority', 'id'),
+    ]
+    # producers enqueueing a uniqkey at the same moment insert one job.
+    unique_together = [('func', 'dedup_key')]
   
-  def save(self):
+  def save(self, *args, **kwargs):
     if not self.id:
       self.enqueue_time = datetime.now()
-      self.grabbed_until = datetime.now()
+      if not self.grabbed_until:
+        self.grabbed_until = self.enqueue_time
     else:
       self.enqueue_time = datetime.now() + timedelta(seconds=self.retry_delay)
-    super(Job, self).save()
+    super(Job, self).save(*args, **kwargs)
+
+class Payload(models.Model):
+  """
+  A large serialized arg, kept out of the Job row and referenced by its arg.
+  """
+  data = models.TextField()
 
 class ExceptionLog(models.Model):
   func = models.ForeignKey(Func)
   message = models.TextField(blank=True)
   arg = models.TextField(blank=True)
-  exception_time = models.DateTimeField(blank=True)
+  exception_time = models.DateTimeField(blank=True, db_index=True)
   uniqkey = models.CharField(max_length=32)
   
-  def save(self):
+  def save(self, *args, **kwargs):
     if not self.id:
       self.exception_time = datetime.now()
+    super(ExceptionLog, self).save(*args, **kwargs)
+
+class CompletedJob(models.Model):
+  """
+  A completed job without its arg, kept for Manager's archive_retention seconds.
+  """
+  job_id = models.PositiveIntegerField()
+  func = models.ForeignKey(Func)
+  uniqkey = models.CharField(max_length=32)
+  enqueue_time = models.DateTimeField()
+  completed_at = models.DateTimeField(db_index=True)
+  retry_cnt = models.PositiveSmallIntegerField(default=0)
+
+class Schedule(models.Model):
+  """
+  A recurring job. Its next job is enqueued by a working Qamasu when next_run_at comes.
+  """
+  name = models.CharField(max_length=100, unique=True)
+  func = models.ForeignKey(Func)
+  arg = models.TextField(blank=True)
+  interval = models.PositiveIntegerField() # seconds
+  next_run_at = models.DateTimeField(db_index=True)
+
+class QueueStat(models.Model):
+  """
+  Cached number of jobs per function, refreshed by Qamasu.stats.
+  """
+  func = models.ForeignKey(Func, unique=True)
+  ready = models.PositiveIntegerField(default=0)
+  leased = models.PositiveIntegerField(default=0)
+  delayed = models.PositiveIntegerField(default=0)
+  oldest_enqueue_time = models.DateTimeField(null=True, blank=True)
+  updated_at = models.DateTimeField(db_index=True)
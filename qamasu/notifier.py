@@ -0,0 +1,166 @@
+"""
+Notifiers wake idle workers up when a job is enqueued.
+
+Manager.enqueue calls notify and Qamasu.work calls wait when it finds no job.
+wait returns early when notified, at the latest after timeout seconds,
+so a lost notification only costs one polling interval.
+"""
+import errno
+import fnmatch
+import os
+import select
+import socket
+import time
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+SOCKET_PATTERN = 'worker-*.sock'
+
+
+def _select(readers, timeout):
+  """
+  Readers ready within timeout, none when a signal(e.g. SIGTERM to terminate gently) interrupts.
+  """
+  try:
+    return select.select(readers, [], [], timeout)[0]
+  except select.error, e:
+    if e.args[0] == errno.EINTR:
+      return []
+    raise
+
+
+class BackoffNotifier(object):
+  """
+  Without any signal, poll with exponential backoff between
+  min_delay and the timeout given to wait.
+  """
+  def __init__(self, min_delay=0.05, factor=2):
+    self.min_delay = min_delay
+    self.factor = factor
+    self.delay = min_delay
+
+  def start(self):
+    pass
+
+  def notify(self):
+    pass
+
+  def wait(self, timeout):
+    delay = min(self.delay, timeout)
+    self.delay = min(self.delay * self.factor, timeout)
+    time.sleep(delay)
+
+  def reset(self):
+    self.delay = self.min_delay
+
+  def close(self):
+    pass
+
+
+class PostgresNotifier(BackoffNotifier):
+  """
+  Use PostgreSQL LISTEN/NOTIFY.
+  NOTIFY is delivered when the enqueuing transaction commits.
+  """
+  def __init__(self, channel='qamasu', using=DEFAULT_DB_ALIAS):
+    super(PostgresNotifier, self).__init__()
+    self.channel = channel
+    self.using = using
+    self._listener = None
+
+  def start(self):
+    if self._listener is None:
+      wrapper = connections[self.using]
+      listener = wrapper.get_new_connection(wrapper.get_connection_params())
+      listener.set_isolation_level(0)
+      listener.cursor().execute('LISTEN %s' % self.channel)
+      self._listener = listener
+
+  def notify(self):
+    connections[self.using].cursor().execute('NOTIFY %s' % self.channel)
+
+  def wait(self, timeout):
+    self.start()
+    listener = self._listener
+    listener.poll()
+    if not listener.notifies and _select([listener], timeout):
+      listener.poll()
+    del listener.notifies[:]
+
+  def close(self):
+    if self._listener is not None:
+      self._listener.close()
+      self._listener = None
+
+
+class SocketNotifier(BackoffNotifier):
+  """
+  Use unix datagram sockets for workers on a single host.
+  Each worker binds a socket in directory and notify sends a datagram to all of them.
+  """
+  def __init__(self, directory='/tmp/qamasu'):
+    super(SocketNotifier, self).__init__()
+    self.directory = directory
+    self._sock = None
+    self._path = None
+
+  def start(self):
+    if self._sock is None:
+      if not os.path.isdir(self.directory):
+        try:
+          os.makedirs(self.directory)
+        except OSError, e:
+          if e.errno != errno.EEXIST:
+            raise
+      self._path = os.path.join(self.directory, SOCKET_PATTERN.replace('*', str(os.getpid())))
+      if os.path.exists(self._path):
+        os.unlink(self._path)
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      sock.setblocking(0)
+      sock.bind(self._path)
+      self._sock = sock
+
+  def notify(self):
+    if not os.path.isdir(self.directory):
+      return
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sender.setblocking(0)
+    try:
+      # other files of directory are not touched.
+      for name in fnmatch.filter(os.listdir(self.directory), SOCKET_PATTERN):
+        path = os.path.join(self.directory, name)
+        try:
+          sender.sendto('1', path)
+        except socket.error, e:
+          if e.errno == errno.ECONNREFUSED:
+            # worker is gone.
+            try:
+              os.unlink(path)
+            except OSError:
+              pass
+    finally:
+      sender.close()
+
+  def wait(self, timeout):
+    self.start()
+    if _select([self._sock], timeout):
+      try:
+        while self._sock.recv(64):
+          pass
+      except socket.error:
+        pass
+
+  def close(self):
+    if self._sock is not None:
+      self._sock.close()
+      self._sock = None
+      try:
+        os.unlink(self._path)
+      except OSError:
+        pass
+
+
+def default_notifier(using=DEFAULT_DB_ALIAS):
+  if connections[using].vendor == 'postgresql':
+    return PostgresNotifier(using=using)
+  return BackoffNotifier()
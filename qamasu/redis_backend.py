@@ -0,0 +1,522 @@
+"""
+Keep the queue in Redis(or a Redis compatible server) instead of the database.
+::
+
+    >>> import redis
+    >>> from qamasu import Qamasu
+    >>> from qamasu.redis_backend import RedisManager
+    >>> qamasu = Qamasu(['workers.random_wait',], manager_class=RedisManager,
+    ...                 manager_options={'client': redis.StrictRedis()})
+    >>> qamasu.register_func('workers.random_wait')
+    >>> qamasu.enqueue('workers.random_wait', {'name': 'qamasu'})
+    >>> qamasu.work()
+
+Each job is a hash and its id is in one of the sorted sets of its function:
+
+  fifo / priority
+    ready jobs ordered by id / by priority and id.
+  leased
+    grabbed jobs scored by grabbed_until.
+  delayed
+    jobs waiting for retry scored by the time they become ready.
+
+Expired leased and delayed jobs go back to the ready sets when a worker looks for jobs.
+A job is grabbed with WATCH/MULTI, so only one worker takes it out of the ready sets.
+Failed jobs are appended to the failed list of their function instead of ExceptionLog,
+and replay_failed_jobs enqueues them again. Schedules are in the schedules hash, their
+next runs in the schedule_runs sorted set.
+"""
+from datetime import datetime
+from itertools import islice
+import calendar
+import time
+import logging
+
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+try:
+  import redis
+  from redis.exceptions import WatchError
+except ImportError:
+  redis = None
+
+from uuid import uuid4 as uuid
+
+from django.core.exceptions import ImproperlyConfigured
+
+from qamasu import Manager, QamasuJob, WorkerModule, BackoffNotifier, ENQUEUE_CHUNK_SIZE, STATS_MAX_AGE
+from qamasu import due_time, serializer
+from qamasu.models import Func, Job
+
+logger = logging.getLogger('qamasu.redis_backend')
+
+# priority is a PositiveSmallIntegerField, so priority * PRIORITY_SCALE + id stays exact in a double.
+PRIORITY_SCALE = 10 ** 11
+READY_SETS = ('fifo', 'priority')
+# fields of the job hash reenqueue can change.
+REENQUEUE_FIELDS = ('arg', 'uniqkey', 'priority', 'retry_cnt')
+
+
+def _timestamp(value):
+  if value.tzinfo is not None:
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1000000.0
+  return time.mktime(value.timetuple()) + value.microsecond / 1000000.0
+
+
+def _text(value):
+  if value is not None and not isinstance(value, str):
+    value = value.decode('utf-8')
+  return value
+
+
+class RedisManager(Manager):
+  """
+  Manager storing jobs in Redis. The client is a redis.StrictRedis compatible object.
+  Functions are identified by their name, so func_id of a job is its function name.
+  """
+  def __init__(self, client=None, prefix='qamasu', **kwargs):
+    if redis is None:
+      raise ImproperlyConfigured('RedisManager requires the redis package.')
+    self.client = client or redis.StrictRedis()
+    self.prefix = prefix
+    self._known_funcs = set()
+    if kwargs.get('notifier') is None:
+      # Qamasu passes notifier=None, and no database notifier sees Redis jobs.
+      kwargs['notifier'] = BackoffNotifier()
+    super(RedisManager, self).__init__(**kwargs)
+
+  def _key(self, *parts):
+    return ':'.join((self.prefix,) + tuple(str(part) for part in parts))
+
+  def _job_key(self, job_id):
+    return self._key('job', job_id)
+
+  def worker(self, func_id):
+    worker = self.func_map.get(func_id, None) or self._worker_registry.get(func_id, None)
+    if worker is None:
+      worker = self._worker_registry[func_id] = WorkerModule(func_id)
+    return worker
+
+  def _func_id(self, funcname):
+    if funcname not in self._known_funcs:
+      if not self.client.sismember(self._key('funcs'), funcname):
+        raise Func.DoesNotExist('Func matching name %s does not exist.' % funcname)
+      self._known_funcs.add(funcname)
+    return funcname
+
+  def register_func(self, func_name):
+    return bool(self.client.sadd(self._key('funcs'), func_name))
+
+  def _funcnames(self):
+    return sorted(_text(name) for name in self.client.smembers(self._key('funcs')))
+
+  def _add_jobs(self, pipe, funcname, job_ids, serialized_args, uniqkeys, priority, run_at=None):
+    now = time.time()
+    for job_id, serialized_arg, uniqkey in zip(job_ids, serialized_args, uniqkeys):
+      pipe.hset(self._job_key(job_id), mapping={'func': funcname, 'arg': serialized_arg, 'uniqkey': uniqkey,
+                                                 'priority': priority, 'retry_cnt': 0, 'enqueue_time': now})
+    if run_at is not None and _timestamp(run_at) > now:
+      # moved to the ready sets when due, like retries.
+      pipe.zadd(self._key('delayed', funcname), dict((job_id, _timestamp(run_at)) for job_id in job_ids))
+      return now
+    pipe.zadd(self._key('fifo', funcname), dict((job_id, job_id) for job_id in job_ids))
+    pipe.zadd(self._key('priority', funcname),
+              dict((job_id, priority * PRIORITY_SCALE + job_id) for job_id in job_ids))
+    return now
+
+  def _check_enqueue(self, funcname, unique):
+    if unique:
+      raise NotImplementedError('RedisManager does not support unique enqueue.')
+    worker = self._enqueue_worker(funcname)
+    if worker and worker.coalesce_window:
+      raise NotImplementedError('RedisManager does not support COALESCE_WINDOW.')
+
+  def enqueue(self, funcname, arg, uniqkey, priority=None, unique=False, run_at=None, delay=None):
+    self._check_enqueue(funcname, unique)
+    funcname = self._func_id(funcname)
+    priority = priority or Job._meta.get_field('priority').default
+    serialized_arg = self._serialize(funcname, arg)
+    job_id = self.client.incr(self._key('ids'))
+    pipe = self.client.pipeline()
+    run_at = due_time(run_at, delay)
+    now = self._add_jobs(pipe, funcname, [job_id], [serialized_arg], [uniqkey], priority, run_at)
+    pipe.execute()
+    self.notifier.notify()
+    enqueue_time = datetime.fromtimestamp(now)
+    return Job(id=job_id, func_id=funcname, arg=serialized_arg, uniqkey=uniqkey, priority=priority,
+               enqueue_time=enqueue_time, grabbed_until=run_at or enqueue_time)
+
+  def enqueue_many(self, funcname, args, priority=None, chunk_size=ENQUEUE_CHUNK_SIZE,
+                   uniqkey=None, unique=False, run_at=None, delay=None):
+    self._check_enqueue(funcname, unique)
+    funcname = self._func_id(funcname)
+    priority = priority or Job._meta.get_field('priority').default
+    run_at = due_time(run_at, delay)
+    args = iter(args)
+    count = 0
+    while 1:
+      chunk = list(islice(args, chunk_size))
+      if not chunk:
+        break
+      last_id = self.client.incrby(self._key('ids'), len(chunk))
+      job_ids = range(last_id - len(chunk) + 1, last_id + 1)
+      pipe = self.client.pipeline()
+      self._add_jobs(pipe, funcname, job_ids, [self._serialize(funcname, arg) for arg in chunk],
+                     [uniqkey and uniqkey(arg) or uuid().hex for arg in chunk], priority, run_at)
+      pipe.execute()
+      count += len(chunk)
+    if count:
+      self.notifier.notify()
+    logger.debug('%d jobs enqueued for %s.' % (count, funcname))
+    return count
+
+  def reenqueue(self, job_data, args):
+    """
+    Store args of REENQUEUE_FIELDS on the job, like Manager.reenqueue.
+    """
+    fields = dict((k, v) for k, v in args.items() if k in REENQUEUE_FIELDS)
+    pipe = self.client.pipeline()
+    if fields:
+      pipe.hset(self._job_key(job_data.id), mapping=fields)
+    if 'priority' in fields:
+      # a ready job keeps its place among jobs of its priority; others get it when requeued.
+      pipe.zadd(self._key('priority', job_data.func_id),
+                {job_data.id: int(fields['priority']) * PRIORITY_SCALE + job_data.id}, xx=True)
+    pipe.hgetall(self._job_key(job_data.id))
+    stored = pipe.execute()[-1]
+    if not stored:
+      raise Job.DoesNotExist('Job matching id %s does not exist.' % job_data.id)
+    return self._job_data(job_data.id, job_data.func_id, stored, job_data.grabbed_until)
+
+  def lookup_job(self, job_id):
+    """
+    Grab the job of job_id if it is ready, None otherwise.
+    """
+    funcname = _text(self.client.hget(self._job_key(job_id), 'func'))
+    if funcname is None:
+      return None
+    now = time.time()
+    self._requeue_expired(funcname, now)
+    jobs = self._grab(funcname, [int(job_id)], now)
+    return jobs and jobs[0] or None
+
+  def replay_failed_jobs(self, funcs=None, since=None, until=None, message=None,
+                         chunk_size=ENQUEUE_CHUNK_SIZE):
+    """
+    Enqueue the failed jobs of funcs matching exception_time in [since, until) and
+    containing message, and remove them from the failed lists, chunk_size jobs per MULTI.
+    Returns the number of enqueued jobs.
+    """
+    since = since and _timestamp(since)
+    until = until and _timestamp(until)
+    def matches(failed):
+      return (since is None or failed['exception_time'] >= since) and \
+             (until is None or failed['exception_time'] < until) and \
+             (not message or message in failed['message'])
+    priority = Job._meta.get_field('priority').default
+    count = 0
+    for funcname in funcs or self._funcnames():
+      key = self._key('failed', funcname)
+      with self.client.pipeline() as pipe:
+        while 1:
+          try:
+            pipe.watch(key)
+            chunk = [value for value in pipe.lrange(key, 0, -1) if matches(json.loads(_text(value)))][:chunk_size]
+            if not chunk:
+              pipe.reset()
+              break
+            failed = [json.loads(_text(value)) for value in chunk]
+            last_id = self.client.incrby(self._key('ids'), len(chunk))
+            pipe.multi()
+            self._add_jobs(pipe, funcname, range(last_id - len(chunk) + 1, last_id + 1),
+                           [f['arg'] for f in failed], [f['uniqkey'] for f in failed], priority)
+            for value in chunk:
+              pipe.lrem(key, 1, value)
+            pipe.execute()
+            count += len(chunk)
+          except WatchError:
+            continue
+    if count:
+      self.notifier.notify()
+    logger.info('%d failed jobs replayed.' % count)
+    return count
+
+  def schedule(self, name, funcname, arg, interval, start_at=None):
+    """
+    Enqueue a job of arg every interval seconds from start_at(now by default).
+    A schedule of the same name is replaced.
+    """
+    funcname = self._func_id(funcname)
+    pipe = self.client.pipeline()
+    pipe.hset(self._key('schedules'), name,
+              json.dumps({'func': funcname, 'arg': serializer.dumps(arg), 'interval': interval}))
+    pipe.zadd(self._key('schedule_runs'), {name: _timestamp(start_at or datetime.now())})
+    pipe.execute()
+
+  def unschedule(self, name):
+    pipe = self.client.pipeline()
+    pipe.hdel(self._key('schedules'), name)
+    pipe.zrem(self._key('schedule_runs'), name)
+    pipe.execute()
+
+  def materialize_schedules(self):
+    """
+    Enqueue the job of every due schedule of abilities, once even if runs were missed.
+    A run is claimed and its job added in one MULTI, so only one worker enqueues it.
+    """
+    now = time.time()
+    runs = self._key('schedule_runs')
+    count = 0
+    for name, next_run_at in self.client.zrangebyscore(runs, '-inf', now, withscores=True):
+      stored = self.client.hget(self._key('schedules'), name)
+      if stored is None:
+        continue
+      schedule = json.loads(_text(stored))
+      funcname = schedule['func']
+      if funcname not in self.func_map:
+        continue
+      interval = schedule['interval']
+      missed = int((now - next_run_at) // interval) + 1
+      job_id = self.client.incr(self._key('ids'))
+      serialized_arg = self._serialize(funcname, serializer.loads(schedule['arg']))
+      with self.client.pipeline() as pipe:
+        try:
+          pipe.watch(runs)
+          if pipe.zscore(runs, name) != next_run_at:
+            pipe.reset()
+            continue
+          pipe.multi()
+          pipe.zadd(runs, {name: next_run_at + interval * missed})
+          self._add_jobs(pipe, funcname, [job_id], [serialized_arg], [uuid().hex],
+                         Job._meta.get_field('priority').default)
+          pipe.execute()
+          count += 1
+        except WatchError:
+          # claimed by another worker.
+          continue
+    if count:
+      self.notifier.notify()
+      logger.debug('%d scheduled jobs enqueued.' % count)
+    return count
+
+  def _requeue_expired(self, funcname, now):
+    """
+    Move leased and delayed jobs whose time has come back to the ready sets.
+    """
+    for name in ('leased', 'delayed'):
+      key = self._key(name, funcname)
+      with self.client.pipeline() as pipe:
+        while 1:
+          try:
+            pipe.watch(key)
+            job_ids = [int(job_id) for job_id in pipe.zrangebyscore(key, '-inf', now)]
+            if not job_ids:
+              pipe.reset()
+              break
+            priorities = [int(pipe.hget(self._job_key(job_id), 'priority') or 0) for job_id in job_ids]
+            pipe.multi()
+            pipe.zrem(key, *job_ids)
+            pipe.zadd(self._key('fifo', funcname), dict((job_id, job_id) for job_id in job_ids))
+            pipe.zadd(self._key('priority', funcname),
+                      dict((job_id, priority * PRIORITY_SCALE + job_id)
+                           for job_id, priority in zip(job_ids, priorities)))
+            pipe.execute()
+            break
+          except WatchError:
+            continue
+
+  def _find_job(self, prioritizing):
+    jobs = self._find_jobs(1, prioritizing)
+    return jobs and jobs[0] or None
+
+  def _find_jobs(self, n, prioritizing):
+    now = time.time()
+    ready_set = prioritizing and 'priority' or 'fifo'
+    heads = []
+    for funcname in self.func_map:
+      self._requeue_expired(funcname, now)
+      for job_id, score in self.client.zrange(self._key(ready_set, funcname), 0, n - 1, withscores=True):
+        heads.append((score, funcname, int(job_id)))
+    heads.sort()
+    candidates = {}
+    for score, funcname, job_id in heads[:n]:
+      candidates.setdefault(funcname, []).append(job_id)
+    grabbed = {}
+    for funcname, job_ids in candidates.items():
+      for job in self._grab(funcname, job_ids, now):
+        grabbed[job.id] = job
+    return [grabbed[job_id] for score, funcname, job_id in heads[:n] if job_id in grabbed]
+
+  def _find_func_jobs(self, func_id, n, prioritizing):
+    now = time.time()
+    self._requeue_expired(func_id, now)
+    ready_set = prioritizing and 'priority' or 'fifo'
+    job_ids = [int(job_id) for job_id in self.client.zrange(self._key(ready_set, func_id), 0, n - 1)]
+    if not job_ids:
+      return []
+    return self._grab(func_id, job_ids, now)
+
+  def _grab(self, funcname, job_ids, now):
+    fifo, priority = [self._key(name, funcname) for name in READY_SETS]
+    grabbed_until = now + self.worker(funcname).grab_for
+    grab_token = uuid().hex
+    with self.client.pipeline() as pipe:
+      while 1:
+        try:
+          pipe.watch(fifo)
+          grabbable = [job_id for job_id in job_ids if pipe.zscore(fifo, job_id) is not None]
+          if not grabbable:
+            pipe.reset()
+            break
+          pipe.multi()
+          pipe.zrem(fifo, *grabbable)
+          pipe.zrem(priority, *grabbable)
+          pipe.zadd(self._key('leased', funcname), dict((job_id, grabbed_until) for job_id in grabbable))
+          for job_id in grabbable:
+            pipe.hset(self._job_key(job_id), 'grab_token', grab_token)
+          pipe.execute()
+          break
+        except WatchError:
+          continue
+    if self.instrumentation:
+      self.instrumentation.grab(funcname, len(job_ids), len(job_ids) - len(grabbable))
+    if not grabbable:
+      return []
+    pipe = self.client.pipeline(transaction=False)
+    for job_id in grabbable:
+      pipe.hgetall(self._job_key(job_id))
+    jobs = [QamasuJob(self, self._job_data(job_id, funcname, fields, datetime.fromtimestamp(grabbed_until)),
+                      grab_token=grab_token)
+            for job_id, fields in zip(grabbable, pipe.execute())]
+    logger.debug('%d jobs grabbed for %s.' % (len(jobs), funcname))
+    return jobs
+
+  def _job_data(self, job_id, funcname, fields, grabbed_until):
+    fields = dict((_text(k), _text(v)) for k, v in fields.items())
+    return Job(id=job_id, func_id=funcname, arg=fields['arg'], uniqkey=fields['uniqkey'],
+               enqueue_time=datetime.fromtimestamp(float(fields['enqueue_time'])),
+               grabbed_until=grabbed_until, retry_cnt=int(fields['retry_cnt']),
+               priority=int(fields['priority']))
+
+  def _remove(self, pipe, job):
+    for name in READY_SETS + ('leased', 'delayed'):
+      pipe.zrem(self._key(name, job.funcname), job.id)
+    pipe.delete(self._job_key(job.id))
+
+  def dequeue(self, job):
+    pipe = self.client.pipeline()
+    self._remove(pipe, job)
+    pipe.execute()
+
+  def _complete_jobs(self, jobs):
+    pipe = self.client.pipeline()
+    for job in jobs:
+      self._remove(pipe, job)
+    pipe.execute()
+
+  def _update_grabbed(self, job, update):
+    """
+    Run update(pipe) in MULTI if job is still grabbed by this worker.
+    """
+    key = self._job_key(job.id)
+    with self.client.pipeline() as pipe:
+      while 1:
+        try:
+          pipe.watch(key)
+          if _text(pipe.hget(key, 'grab_token')) != job.grab_token or \
+             pipe.zscore(self._key('leased', job.funcname), job.id) is None:
+            pipe.reset()
+            return False
+          pipe.multi()
+          update(pipe)
+          pipe.execute()
+          return True
+        except WatchError:
+          continue
+
+  def extend(self, job, seconds):
+    grabbed_until = time.time() + seconds
+    def update(pipe):
+      pipe.zadd(self._key('leased', job.funcname), {job.id: grabbed_until})
+    extended = self._update_grabbed(job, update)
+    if extended:
+      job.grabbed_until = datetime.fromtimestamp(grabbed_until)
+      logger.debug('Job id:%d grabbed until %s.' % (job.id, job.grabbed_until))
+    return extended
+
+  def release(self, jobs):
+    for job in jobs:
+      def update(pipe, job=job):
+        pipe.zrem(self._key('leased', job.funcname), job.id)
+        pipe.zadd(self._key('fifo', job.funcname), {job.id: job.id})
+        pipe.zadd(self._key('priority', job.funcname),
+                  {job.id: job.org_job.priority * PRIORITY_SCALE + job.id})
+        pipe.hset(self._job_key(job.id), 'grab_token', '')
+      self._update_grabbed(job, update)
+
+  def _retry(self, job, delay):
+    def update(pipe):
+      pipe.zrem(self._key('leased', job.funcname), job.id)
+      pipe.zadd(self._key('delayed', job.funcname), {job.id: time.time() + delay})
+      pipe.hincrby(self._job_key(job.id), 'retry_cnt', 1)
+    return self._update_grabbed(job, update)
+
+  def _fail(self, job, exception):
+    pipe = self.client.pipeline()
+    pipe.rpush(self._key('failed', job.funcname),
+               json.dumps({'id': job.id, 'uniqkey': job.uniqkey, 'arg': job.org_job.arg,
+                           'message': str(exception), 'exception_time': time.time()}))
+    self._remove(pipe, job)
+    pipe.execute()
+
+  def failed_jobs(self, funcname):
+    """
+    Returns the failed jobs of funcname as dicts, oldest first.
+    """
+    return [json.loads(_text(value)) for value in self.client.lrange(self._key('failed', funcname), 0, -1)]
+
+  def purge(self):
+    pipe = self.client.pipeline()
+    for name in ('job',) + READY_SETS + ('leased', 'delayed'):
+      for key in self.client.scan_iter(match=self._key(name, '*')):
+        pipe.delete(key)
+    pipe.execute()
+
+  def job_count(self, funcs=None):
+    pipe = self.client.pipeline(transaction=False)
+    for funcname in funcs or self._funcnames():
+      for name in ('fifo', 'leased', 'delayed'):
+        pipe.zcard(self._key(name, funcname))
+    return sum(pipe.execute())
+
+  def stats(self, max_age=STATS_MAX_AGE):
+    """
+    Counted on every call; ZCARD and ZCOUNT are cheap, so nothing is cached.
+    oldest_enqueue_time is the one of the oldest ready job.
+    """
+    now = time.time()
+    result = {}
+    for funcname in self._funcnames():
+      pipe = self.client.pipeline(transaction=False)
+      for name in ('fifo', 'leased', 'delayed'):
+        pipe.zcard(self._key(name, funcname))
+      # expired leases and retries are ready, even if nobody has requeued them yet.
+      pipe.zcount(self._key('leased', funcname), '-inf', now)
+      pipe.zcount(self._key('delayed', funcname), '-inf', now)
+      pipe.zrange(self._key('fifo', funcname), 0, 0)
+      ready, leased, delayed, expired_leased, expired_delayed, head = pipe.execute()
+      oldest_enqueue_time = None
+      if head:
+        enqueue_time = self.client.hget(self._job_key(int(head[0])), 'enqueue_time')
+        if enqueue_time is not None:
+          oldest_enqueue_time = datetime.fromtimestamp(float(enqueue_time))
+      result[funcname] = dict(ready=ready + expired_leased + expired_delayed,
+                              leased=leased - expired_leased, delayed=delayed - expired_delayed,
+                              oldest_enqueue_time=oldest_enqueue_time)
+    return result
+
+  def refresh_stats(self):
+    pass
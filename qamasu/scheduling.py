@@ -0,0 +1,82 @@
+"""
+Policies choosing which function of its abilities a worker serves next.
+
+Without a scheduler, Manager takes the oldest(or most prior) job of all abilities at once,
+so a function with a large backlog delays all the others. With one, Manager asks it for
+the order of functions, with how many of n jobs each should take, and looks for jobs
+of one function at a time.
+::
+
+    >>> from qamasu import Qamasu, WeightedScheduler
+    >>> qamasu = Qamasu(['workers.mail', 'workers.report'],
+    ...                 scheduler=WeightedScheduler({'workers.mail': 9, 'workers.report': 1}))
+"""
+import time
+
+
+class WeightedScheduler(object):
+  """
+  Smooth weighted round robin. A function gets its weight's share of jobs
+  while it has jobs; an empty function does not save up credit(as deficit round robin).
+  """
+  def __init__(self, weights=None, default_weight=1):
+    self.weights = weights or {}
+    self.default_weight = default_weight
+    self.credits = {}
+
+  def weight(self, funcname):
+    return self.weights.get(funcname, self.default_weight)
+
+  def order(self, funcnames, n=1):
+    """
+    Credit each function its weight per job to take, and split n jobs the way
+    n single picks would, so a batch keeps the weights.
+    """
+    total = sum(self.weight(funcname) for funcname in funcnames)
+    for funcname in funcnames:
+      self.credits[funcname] = self.credits.get(funcname, 0) + self.weight(funcname) * n
+    credits = dict((funcname, self.credits[funcname]) for funcname in funcnames)
+    shares = dict((funcname, 0) for funcname in funcnames)
+    for i in range(n):
+      funcname = max(funcnames, key=lambda funcname: credits[funcname])
+      credits[funcname] -= total
+      shares[funcname] += 1
+    return sorted([(funcname, shares[funcname]) for funcname in funcnames],
+                  key=lambda plan: (-plan[1], -self.credits[plan[0]]))
+
+  def picked(self, funcnames, funcname, count=1):
+    self.credits[funcname] -= sum(self.weight(name) for name in funcnames) * count
+
+  def empty(self, funcname):
+    self.credits[funcname] = 0
+
+
+class PriorityBandScheduler(object):
+  """
+  Serve functions in a lower band first. A function rises one band every aging seconds
+  it is not served, so jobs of the highest band can not starve the others.
+  """
+  def __init__(self, bands=None, default_band=0, aging=60):
+    self.bands = bands or {}
+    self.default_band = default_band
+    self.aging = aging
+    self.served = {}
+
+  def band(self, funcname, now):
+    served = self.served.setdefault(funcname, now)
+    band = self.bands.get(funcname, self.default_band)
+    if self.aging:
+      band -= int((now - served) / self.aging)
+    return band
+
+  def order(self, funcnames, n=1):
+    now = time.time()
+    funcnames = sorted(funcnames, key=lambda funcname: (self.band(funcname, now), self.served[funcname]))
+    return [(funcname, i == 0 and n or 0) for i, funcname in enumerate(funcnames)]
+
+  def picked(self, funcnames, funcname, count=1):
+    self.served[funcname] = time.time()
+
+  def empty(self, funcname):
+    # nothing waits, so nothing ages.
+    self.served[funcname] = time.time()
@@ -0,0 +1,90 @@
+"""
+Serialization of job arguments.
+
+A worker module chooses how its args are stored with optional attributes:
+
+  SERIALIZER
+    name of a registered serializer, 'json'(default) or 'msgpack'.
+  COMPRESS_THRESHOLD
+    compress serialized args of this many bytes or more with zlib.
+
+Plain JSON args are stored as JSON text like before. Others are tagged,
+``!msgpack+zlib:<base64>``, so a row is decoded whatever its func says now.
+JSON never starts with '!', so old rows are decoded as JSON.
+"""
+import base64
+import zlib
+
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+TAG = '!'
+
+
+class JSONSerializer(object):
+  def dumps(self, arg):
+    data = json.dumps(arg, ensure_ascii=False)
+    if not isinstance(data, bytes):
+      data = data.encode('utf-8')
+    return data
+
+  def loads(self, data):
+    return json.loads(data.decode('utf-8'))
+
+
+class MsgpackSerializer(object):
+  def dumps(self, arg):
+    return msgpack.packb(arg, use_bin_type=True)
+
+  def loads(self, data):
+    return msgpack.unpackb(data, raw=False)
+
+
+SERIALIZERS = {'json': JSONSerializer()}
+if msgpack is not None:
+  SERIALIZERS['msgpack'] = MsgpackSerializer()
+
+
+def register_serializer(name, serializer):
+  """
+  serializer has dumps(arg) returning bytes and loads(bytes).
+  """
+  if TAG in name or ':' in name or '+' in name:
+    raise ValueError('Invalid serializer name %s.' % name)
+  SERIALIZERS[name] = serializer
+
+
+def dumps(arg, serializer='json', compress_threshold=None):
+  if serializer == 'json' and compress_threshold is None:
+    return json.dumps(arg, ensure_ascii=False)
+  data = SERIALIZERS[serializer].dumps(arg)
+  tag = serializer
+  if compress_threshold is not None and len(data) >= compress_threshold:
+    data = zlib.compress(data)
+    tag += '+zlib'
+  elif serializer == 'json':
+    return data.decode('utf-8')
+  return '%s%s:%s' % (TAG, tag, base64.b64encode(data).decode('ascii'))
+
+
+def loads(text):
+  if not text.startswith(TAG):
+    return json.loads(text)
+  tag, payload = text[len(TAG):].split(':', 1)
+  if '+' in tag:
+    name, compression = tag.split('+', 1)
+  else:
+    name, compression = tag, None
+  data = base64.b64decode(payload)
+  if compression == 'zlib':
+    data = zlib.decompress(data)
+  elif compression:
+    raise ValueError('Unknown compression %s.' % compression)
+  return SERIALIZERS[name].loads(data)
@@ -0,0 +1,245 @@
+"""
+Spread the queue over several databases when one database can not keep up.
+::
+
+    >>> from qamasu import Qamasu
+    >>> from qamasu.sharding import ShardedManager
+    >>> qamasu = Qamasu(['workers.random_wait',], manager_class=ShardedManager,
+    ...                 manager_options={'databases': ['queue0', 'queue1']})
+    >>> qamasu.register_func('workers.random_wait')
+    >>> qamasu.enqueue('workers.random_wait', {'name': 'qamasu'})
+    >>> qamasu.work()
+
+Every alias of databases is a shard having all tables of qamasu(run migrate for each).
+ShardedManager keeps a Manager for each shard, with the same options, and
+
+  enqueue
+    routes a job by crc32 of its function name(shard_by='func') or its uniqkey(shard_by='uniqkey').
+    Jobs of a uniqkey always share a shard, so unique enqueue and coalescing work as before.
+  find_job(s)
+    polls shards in turn(polling='round_robin'), or first the shard chosen at random
+    weighted by its ready jobs(polling='depth'), read from stats at most depth_check_seconds old.
+  stats, job_count, purge, replay_failed_jobs ...
+    aggregate all shards.
+
+A job found is owned by the Manager of its shard, completed, retried and failed there.
+Job ids are per shard, so lookup_job grabs the job of the first shard having one.
+"""
+from itertools import islice
+from random import uniform
+import time
+import zlib
+import logging
+
+from uuid import uuid4 as uuid
+
+from django.core.exceptions import ImproperlyConfigured
+
+from qamasu import Manager, ENQUEUE_CHUNK_SIZE, PRUNE_CHUNK_SIZE, STATS_MAX_AGE
+
+logger = logging.getLogger('qamasu.sharding')
+
+DEPTH_CHECK_SECONDS = 5
+SHARD_BY = ('func', 'uniqkey')
+POLLING = ('round_robin', 'depth')
+
+
+def shard_index(key, size):
+  if not isinstance(key, bytes):
+    key = key.encode('utf-8')
+  # crc32 is the same in every process, unlike hash().
+  return (zlib.crc32(key) & 0xffffffff) % size
+
+
+class ShardedManager(Manager):
+  """
+  Manager routing jobs to a Manager per database alias of databases.
+  """
+  def __init__(self, databases=None, shard_by='func', polling='round_robin',
+               depth_check_seconds=DEPTH_CHECK_SECONDS, **kwargs):
+    if not databases:
+      raise ImproperlyConfigured('ShardedManager requires databases.')
+    if shard_by not in SHARD_BY:
+      raise ValueError('Unknown shard_by %s.' % shard_by)
+    if polling not in POLLING:
+      raise ValueError('Unknown polling %s.' % polling)
+    self.databases = list(databases)
+    self.shard_by = shard_by
+    self.polling = polling
+    self.depth_check_seconds = depth_check_seconds
+    self._next_shard = -1
+    self._depths = [0] * len(self.databases)
+    self._depth_checked = 0
+    kwargs.pop('using', None)
+    super(ShardedManager, self).__init__(using=self.databases[0], **kwargs)
+    # jobs are prefetched here from all shards, the shards only grab them.
+    for name in ('prefetch', 'prefetch_in_background', 'notifier'):
+      kwargs.pop(name, None)
+    self.shards = [Manager(using=alias, notifier=self.notifier, **kwargs) for alias in self.databases]
+
+  def _shard(self, funcname, key=None):
+    if self.shard_by == 'func':
+      key = funcname
+    return self.shards[shard_index(key, len(self.shards))]
+
+  def enqueue(self, funcname, arg, uniqkey, priority=None, unique=False, run_at=None, delay=None):
+    return self._shard(funcname, uniqkey).enqueue(funcname, arg, uniqkey, priority=priority, unique=unique,
+                                                  run_at=run_at, delay=delay)
+
+  def enqueue_many(self, funcname, args, priority=None, chunk_size=ENQUEUE_CHUNK_SIZE,
+                   uniqkey=None, unique=False, run_at=None, delay=None):
+    if self.shard_by == 'func':
+      return self._shard(funcname).enqueue_many(funcname, args, priority=priority, chunk_size=chunk_size,
+                                                uniqkey=uniqkey, unique=unique, run_at=run_at, delay=delay)
+    if unique and uniqkey is None:
+      raise ValueError('unique enqueue_many needs uniqkey.')
+    args = iter(args)
+    count = 0
+    while 1:
+      chunk = list(islice(args, chunk_size))
+      if not chunk:
+        break
+      keyed = {}
+      for arg in chunk:
+        key = uniqkey and uniqkey(arg) or uuid().hex
+        keyed.setdefault(shard_index(key, len(self.shards)), []).append((key, arg))
+      for index, pairs in keyed.items():
+        # Manager.enqueue_many asks the uniqkey of each arg once, in order.
+        keys = iter([key for key, arg in pairs])
+        count += self.shards[index].enqueue_many(funcname, [arg for key, arg in pairs], priority=priority,
+                                                 chunk_size=chunk_size, uniqkey=lambda arg: next(keys),
+                                                 unique=unique, run_at=run_at, delay=delay)
+    return count
+
+  def reenqueue(self, job_data, args):
+    return job_data.manager.reenqueue(job_data, args)
+
+  def dequeue(self, job):
+    job.manager.dequeue(job)
+
+  def complete(self, job):
+    job.manager.complete(job)
+
+  def extend(self, job, seconds):
+    return job.manager.extend(job, seconds)
+
+  def retry_or_fail(self, job, exception):
+    job.manager.retry_or_fail(job, exception)
+
+  def release(self, jobs):
+    jobs_by_shard = {}
+    for job in jobs:
+      jobs_by_shard.setdefault(job.manager, []).append(job)
+    for shard, shard_jobs in jobs_by_shard.items():
+      shard.release(shard_jobs)
+
+  def flush(self, force=True):
+    return sum(shard.flush(force=force) for shard in self.shards)
+
+  def prune_archive(self, retention=None):
+    for shard in self.shards:
+      shard.prune_archive(retention)
+
+  def close(self):
+    super(ShardedManager, self).close()
+    for shard in self.shards:
+      shard.close()
+
+  def lookup_job(self, job_id):
+    """
+    Grab the ready job of job_id of the first shard having one. Ids are numbered per shard,
+    so two shards may have a job of the same id.
+    """
+    for shard in self.shards:
+      job = shard.lookup_job(job_id)
+      if job is not None:
+        return job
+    return None
+
+  def _polled_shards(self):
+    if self.polling == 'depth':
+      if time.time() - self._depth_checked >= self.depth_check_seconds:
+        self._depths = [self._ready(shard) for shard in self.shards]
+        self._depth_checked = time.time()
+      # weighted random order, an empty shard is still polled last as counts get old.
+      keys = [uniform(0, 1) ** (1.0 / (depth + 1)) for depth in self._depths]
+      return sorted(range(len(self.shards)), key=lambda index: -keys[index])
+    self._next_shard = (self._next_shard + 1) % len(self.shards)
+    return range(self._next_shard, len(self.shards)) + range(self._next_shard)
+
+  def _ready(self, shard):
+    # cached QueueStat rows shared by all workers, instead of counting jobs in every worker.
+    stats = shard.stats(max_age=self.depth_check_seconds)
+    return sum(stat['ready'] for funcname, stat in stats.items() if funcname in self.func_map)
+
+  def _found(self, index, count):
+    if self.polling != 'depth':
+      return
+    if count:
+      self._depths[index] = max(self._depths[index] - count, 0)
+    else:
+      self._depths[index] = 0
+
+  def _find_job(self, prioritizing):
+    for index in self._polled_shards():
+      job = self.shards[index]._find_job(prioritizing)
+      self._found(index, int(job is not None))
+      if job is not None:
+        return job
+    return None
+
+  def _find_jobs(self, n, prioritizing):
+    jobs = []
+    for index in self._polled_shards():
+      found = self.shards[index]._find_jobs(n - len(jobs), prioritizing)
+      self._found(index, len(found))
+      jobs.extend(found)
+      if len(jobs) >= n:
+        break
+    return jobs
+
+  def register_func(self, func_name):
+    return any([shard.register_func(func_name) for shard in self.shards])
+
+  def schedule(self, name, funcname, arg, interval, start_at=None):
+    return self._shard(funcname, name).schedule(name, funcname, arg, interval, start_at=start_at)
+
+  def unschedule(self, name):
+    for shard in self.shards:
+      shard.unschedule(name)
+
+  def materialize_schedules(self):
+    return sum(shard.materialize_schedules() for shard in self.shards)
+
+  def replay_failed_jobs(self, funcs=None, since=None, until=None, message=None,
+                         chunk_size=ENQUEUE_CHUNK_SIZE):
+    # a failed job is logged in its shard, so it is replayed to the shard it is routed to.
+    return sum(shard.replay_failed_jobs(funcs=funcs, since=since, until=until, message=message,
+                                        chunk_size=chunk_size)
+               for shard in self.shards)
+
+  def prune_exceptions(self, older_than, funcs=None, chunk_size=PRUNE_CHUNK_SIZE):
+    return sum(shard.prune_exceptions(older_than, funcs=funcs, chunk_size=chunk_size) for shard in self.shards)
+
+  def purge(self):
+    for shard in self.shards:
+      shard.purge()
+
+  def job_count(self, funcs=None):
+    return sum(shard.job_count(funcs=funcs) for shard in self.shards)
+
+  def stats(self, max_age=STATS_MAX_AGE):
+    result = {}
+    for shard in self.shards:
+      for funcname, stat in shard.stats(max_age=max_age).items():
+        total = result.setdefault(funcname, dict(ready=0, leased=0, delayed=0, oldest_enqueue_time=None))
+        for field in ('ready', 'leased', 'delayed'):
+          total[field] += stat[field]
+        oldest = stat['oldest_enqueue_time']
+        if oldest is not None and (total['oldest_enqueue_time'] is None or oldest < total['oldest_enqueue_time']):
+          total['oldest_enqueue_time'] = oldest
+    return result
+
+  def refresh_stats(self):
+    for shard in self.shards:
+      shard.refresh_stats()
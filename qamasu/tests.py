@@ -1,7 +1,30 @@
 import unittest
 
-from qamasu import Qamasu
-from qamasu.models import Func
+from datetime import datetime, timedelta
+import json
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from django.db import connection, IntegrityError
+
+from qamasu import Qamasu, OptimisticGrabStrategy, SkipLockedGrabStrategy, default_grab_strategy
+from qamasu import supports_skip_locked, atomic
+from qamasu import BackoffNotifier, SocketNotifier, Metrics, backoff_seconds
+from qamasu import WeightedScheduler, PriorityBandScheduler
+from qamasu import serializer
+from qamasu.notifier import PostgresNotifier
+from qamasu.redis_backend import RedisManager
+from qamasu.sharding import ShardedManager, shard_index
+from qamasu.models import Func, Job, Payload, Schedule, CompletedJob, ExceptionLog, QueueStat
+
+try:
+  import fakeredis
+except ImportError:
+  fakeredis = None
 
 class QamasuTestCase(unittest.TestCase):
 
@@ -257,6 +280,703 @@ class QamasuTestCase(unittest.TestCase):
 
     self.assertEquals(len(qamasu_w_two.job_list()), 3)
 
+  def testFindJobs(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.register_func('test_worker.for_test_two')
+    for number in range(1, 6):
+      self.qamasu.enqueue('test_worker.for_test_one', dict(number=number))
+    self.qamasu.enqueue('test_worker.for_test_two', dict(number=6))
+
+    qamasu_w_both = Qamasu(['test_worker.for_test_one', 'test_worker.for_test_two'])
+    jobs = qamasu_w_both.manager.find_jobs(3)
+    self.assertEquals([job.arg['number'] for job in jobs], [1, 2, 3])
+    self.assertEquals(len(set([job.grab_token for job in jobs])), 1)
+    jobs = qamasu_w_both.manager.find_jobs(10)
+    self.assertEquals([job.arg['number'] for job in jobs], [4, 5, 6])
+    self.assertEquals(jobs[-1].funcname, 'test_worker.for_test_two')
+    self.failIf(qamasu_w_both.manager.find_jobs(10))
+    for job in jobs:
+      job.complete()
+    self.assertEquals(self.qamasu.job_count(), 3)
+
+  def testWorkBatch(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    for number in range(1, 6):
+      self.qamasu.enqueue('test_worker.for_test_one', dict(number=number))
+    self.assertEquals(self.qamasu.manager.work_batch(4), 4)
+    self.assertEquals(self.qamasu.job_count(), 1)
+    self.assertEquals(self.qamasu.manager.work_batch(4), 1)
+    self.assertEquals(self.qamasu.manager.work_batch(4), 0)
+
+    # a job whose grab ran out while it waited in the batch is left to its new worker.
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(3)])
+    manager = self.qamasu.manager
+    find_jobs = manager.find_jobs
+    def find_jobs_losing(n, prioritizing=False):
+      jobs = find_jobs(n, prioritizing=prioritizing)
+      jobs[1].grabbed_until = datetime.now()
+      Job.objects.filter(pk=jobs[1].id).update(grab_token='other')
+      return jobs
+    manager.find_jobs = find_jobs_losing
+    self.assertEquals(manager.work_batch(3), 2)
+    self.assertEquals(list(Job.objects.values_list('grab_token', flat=True)), ['other'])
+
+  def testDefaultGrabStrategy(self):
+    strategy = default_grab_strategy()
+    if supports_skip_locked():
+      self.assertTrue(isinstance(strategy, SkipLockedGrabStrategy))
+    else:
+      self.assertTrue(isinstance(strategy, OptimisticGrabStrategy))
+
+  def testOptimisticGrabStrategy(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=2))
+    qamasu = Qamasu(['test_worker.for_test_one'], grab_strategy=OptimisticGrabStrategy())
+    job = qamasu.manager.find_job()
+    self.assertEquals(job.arg['number'], 1)
+    jobs = qamasu.manager.find_jobs(2)
+    self.assertEquals([j.arg['number'] for j in jobs], [2])
+    self.failIf(qamasu.manager.find_job())
+
+  def testSkipLockedGrabStrategy(self):
+    if not supports_skip_locked():
+      self.skipTest('%s does not support SKIP LOCKED.' % connection.vendor)
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=2))
+    qamasu = Qamasu(['test_worker.for_test_one'], grab_strategy=SkipLockedGrabStrategy())
+    locked = threading.Event()
+    finish = threading.Event()
+    def lock_first():
+      try:
+        with atomic():
+          list(Job.objects.select_for_update().order_by('id')[:1])
+          locked.set()
+          finish.wait()
+      finally:
+        connection.close()
+    locker = threading.Thread(target=lock_first)
+    locker.start()
+    try:
+      locked.wait()
+      # the locked row is skipped, not waited for.
+      self.assertEquals(qamasu.manager.find_job().arg['number'], 2)
+    finally:
+      finish.set()
+      locker.join()
+    self.assertEquals([job.arg['number'] for job in qamasu.manager.find_jobs(2)], [1])
+    self.failIf(qamasu.manager.find_job())
+
+  def testEnqueueMany(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    args = (dict(number=number) for number in range(1, 8))
+    self.assertEquals(self.qamasu.enqueue_many('test_worker.for_test_one', args, chunk_size=3), 7)
+    self.assertEquals(self.qamasu.job_count(), 7)
+    jobs = self.qamasu.manager.find_jobs(10)
+    self.assertEquals([job.arg['number'] for job in jobs], range(1, 8))
+    self.assertEquals(self.qamasu.enqueue_many('test_worker.for_test_one', []), 0)
+
+  def testEnqueueManyWithPriority(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=2)], priority=1)
+    job = self.qamasu.manager.find_job(prioritizing=True)
+    self.assertEquals(job.arg['number'], 2)
+    self.assertEquals(job.org_job.priority, 1)
+
+  def testFindJobUsesReadyIndex(self):
+    if connection.vendor != 'sqlite':
+      self.skipTest('EXPLAIN QUERY PLAN is for SQLite.')
+    from django.test.utils import CaptureQueriesContext
+    cursor = connection.cursor()
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'qamasu_job'")
+    indexes = dict((sql.split('(', 1)[1].replace('"', '').replace(' ', '').rstrip(')'), name)
+                   for name, sql in cursor.fetchall() if sql)
+    due_index = indexes['func_id,grabbed_until']
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.register_func('test_worker.for_test_two')
+    qamasu_w_both = Qamasu(['test_worker.for_test_one', 'test_worker.for_test_two'])
+    for funcname in ('test_worker.for_test_one', 'test_worker.for_test_two'):
+      self.qamasu.enqueue_many(funcname, [dict(number=n) for n in range(3)])
+      self.qamasu.enqueue_many(funcname, [dict(number=n) for n in range(3)], delay=60)
+    manager = qamasu_w_both.manager
+    job_ids = list(Job.objects.order_by('id').values_list('id', flat=True))
+    def plan(job_list):
+      sql, params = job_list.query.sql_with_params()
+      cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+      plan = ' '.join([row[-1] for row in cursor.fetchall()])
+      self.failIf('JOIN' in plan or 'qamasu_func' in plan, plan)
+      return plan
+    func_ids = manager._ability_func_ids()
+    self.assertEquals(len(func_ids), 2)
+    for func_id in func_ids:
+      # a few ready jobs are found by due time, not by reading the delayed ones.
+      found = plan(manager._ready_jobs(func_id, datetime.now()).values_list('id', flat=True)[:100])
+      self.assertTrue(due_index in found, found)
+      self.failIf('TEMP B-TREE' in found, found)
+      for prioritizing in (False, True):
+        ready = manager._ready_ids(func_id, prioritizing=prioritizing)
+        self.failIf('SCAN' in plan(manager._candidates(ready, prioritizing=prioritizing)[:4]))
+    # a backlog is read in order, not sorted.
+    manager.ready_scan_size = 2
+    for prioritizing, ready_index in ((False, indexes['func_id']), (True, indexes['func_id,priority,id'])):
+      for func_id in func_ids:
+        found = plan(manager._ordered_jobs(func_id, prioritizing=prioritizing).values_list('id', 'grabbed_until')[:2])
+        self.assertTrue(ready_index in found, found)
+        self.failIf('TEMP B-TREE' in found, found)
+        ready = manager._ready_ids(func_id, prioritizing=prioritizing)
+        self.failIf('SCAN' in plan(manager._candidates(ready, prioritizing=prioritizing)[:4]))
+      # abilities are merged, not read by one query sorting them all.
+      with CaptureQueriesContext(connection) as queries:
+        jobs = manager.find_jobs(4, prioritizing=prioritizing)
+      self.assertEquals([job.id for job in jobs], job_ids[:3] + job_ids[6:7])
+      manager.release(jobs)
+      for query in queries.captured_queries:
+        self.failIf('"func_id" IN' in query['sql'], query['sql'])
+    # a head of running jobs is passed by the jobs due first.
+    running = manager.find_jobs(2)
+    self.assertEquals([job.id for job in manager.find_jobs(2)], [job_ids[2], job_ids[6]])
+
+  def testWorkMaxJobs(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(3)])
+    self.assertEquals(self.qamasu.work(work_delay=0, max_jobs=2), 2)
+    self.assertEquals(self.qamasu.job_count(), 1)
+
+  def testWorkConcurrently(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(5)])
+    try:
+      self.assertEquals(self.qamasu.manager.work_concurrently(3), 3)
+      self.assertEquals(self.qamasu.manager.work_concurrently(3), 2)
+      self.assertEquals(self.qamasu.manager.work_concurrently(3), 0)
+    finally:
+      self.qamasu.manager.close()
+    self.assertEquals(self.qamasu.job_count(), 0)
+
+  def testWorkConcurrentlyRaises(self):
+    qamasu = Qamasu(['test_worker.for_test_fail'])
+    qamasu.register_func('test_worker.for_test_fail')
+    qamasu.enqueue('test_worker.for_test_fail', dict(number=1))
+    def retry_or_fail(job, exception):
+      raise RuntimeError('retry failed')
+    qamasu.manager.retry_or_fail = retry_or_fail
+    try:
+      self.assertRaises(RuntimeError, qamasu.manager.work_concurrently, 2)
+    finally:
+      qamasu.manager.close()
+
+  def testThreadPoolKeepsPrefetched(self):
+    qamasu = Qamasu(['test_worker.for_test_one',],
+                    manager_options={'prefetch': 2, 'prefetch_in_background': False})
+    qamasu.register_func('test_worker.for_test_one')
+    qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(3)])
+    qamasu.manager.find_job().complete()
+    try:
+      qamasu.manager._get_thread_pool(2)
+      # a pool of another size does not release the prefetched job.
+      qamasu.manager._get_thread_pool(3)
+      self.assertEquals(len(qamasu.manager._prefetched), 1)
+      self.assertEquals(Job.objects.exclude(grab_token='').count(), 1)
+    finally:
+      qamasu.manager.close()
+
+  def testBackoffNotifier(self):
+    notifier = BackoffNotifier(min_delay=0.001)
+    notifier.wait(0.004)
+    notifier.wait(0.004)
+    self.assertEquals(notifier.delay, 0.004)
+    notifier.wait(0.004)
+    self.assertEquals(notifier.delay, 0.004)
+    notifier.reset()
+    self.assertEquals(notifier.delay, 0.001)
+
+  def testSocketNotifier(self):
+    directory = tempfile.mkdtemp()
+    try:
+      worker = SocketNotifier(directory=directory)
+      worker.start()
+      qamasu = Qamasu(['test_worker.for_test_one'], notifier=SocketNotifier(directory=directory))
+      qamasu.register_func('test_worker.for_test_one')
+      qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+      started = time.time()
+      worker.wait(5)
+      self.assertTrue(time.time() - started < 1)
+      worker.close()
+      self.assertEquals(os.listdir(directory), [])
+      # only sockets of workers are notified and cleaned up.
+      open(os.path.join(directory, 'qamasu.pid'), 'w').close()
+      qamasu.manager.notifier.notify()
+      self.assertEquals(os.listdir(directory), ['qamasu.pid'])
+    finally:
+      shutil.rmtree(directory)
+
+  def testWorkPoolRestartDelay(self):
+    qamasu = Qamasu(['test_worker.for_test_one'])
+    qamasu._work_child = lambda *args: os._exit(1)
+    forks = []
+    fork = os.fork
+    def counting_fork():
+      pid = fork()
+      if pid:
+        forks.append(pid)
+      return pid
+    os.fork = counting_fork
+    previous_handler = signal.signal(signal.SIGALRM, qamasu.handle_terminate)
+    try:
+      signal.setitimer(signal.ITIMER_REAL, 0.5)
+      qamasu.work_pool(processes=2, restart_seconds=0.2)
+    finally:
+      os.fork = fork
+      signal.signal(signal.SIGALRM, previous_handler)
+    # crashing workers are forked once per restart_seconds, not in a tight loop.
+    self.assertTrue(2 <= len(forks) <= 8, len(forks))
+
+  def testNotifierInterrupted(self):
+    directory = tempfile.mkdtemp()
+    previous_handler = signal.signal(signal.SIGALRM, lambda *args: None)
+    notifiers = [SocketNotifier(directory=directory)]
+    if connection.vendor == 'postgresql':
+      notifiers.append(PostgresNotifier())
+    try:
+      for worker in notifiers:
+        worker.start()
+        signal.setitimer(signal.ITIMER_REAL, 0.1)
+        started = time.time()
+        # returns to let the work loop check gentle_terminate.
+        worker.wait(5)
+        self.assertTrue(time.time() - started < 1)
+        worker.close()
+    finally:
+      signal.signal(signal.SIGALRM, previous_handler)
+      shutil.rmtree(directory)
+
+  def testWorkerRegistry(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    manager = self.qamasu.manager
+    worker = manager.func_map['test_worker.for_test_one']
+    self.assertEquals(worker.grab_for, 50)
+    job = manager.find_job()
+    self.assertTrue(manager.worker(job.func_id) is worker)
+    self.assertEquals(job.funcname, 'test_worker.for_test_one')
+
+  def testExtend(self):
+    self.qamasu.register_func('test_worker.for_test_two')
+    self.qamasu.enqueue('test_worker.for_test_two', dict(number=1))
+    qamasu = Qamasu(['test_worker.for_test_two'])
+    job = qamasu.manager.find_job()
+    self.assertTrue(job.extend(-1))
+    # grab expired, another worker can grab it.
+    other = qamasu.manager.find_job()
+    self.assertEquals(other.id, job.id)
+    self.failIf(job.extend(10))
+    self.assertTrue(other.extend(10))
+    self.failIf(qamasu.manager.find_job())
+
+  def testRetryAndFail(self):
+    self.qamasu.register_func('test_worker.for_test_fail')
+    self.qamasu.enqueue('test_worker.for_test_fail', dict(number=1))
+    qamasu = Qamasu(['test_worker.for_test_fail'])
+    for retry_cnt in range(3):
+      self.assertEquals(qamasu.job_list()[0].retry_cnt, retry_cnt)
+      self.assertEquals(qamasu.manager.work_batch(1), 1)
+    self.assertEquals(qamasu.job_count(), 0)
+    exceptions = qamasu.exception_list()
+    self.assertEquals(exceptions.count(), 1)
+    self.assertEquals(exceptions[0].message, 'failed 1')
+
+  def testBackoffSeconds(self):
+    for retry_cnt in range(5):
+      delay = backoff_seconds(2, retry_cnt)
+      self.assertTrue(2 ** retry_cnt <= delay <= 2 ** (retry_cnt + 1))
+    self.assertTrue(backoff_seconds(2, 30, max_delay=60) <= 60)
+
+  def testMetrics(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.register_func('test_worker.for_test_fail')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    self.qamasu.enqueue('test_worker.for_test_fail', dict(number=2))
+    metrics = Metrics()
+    qamasu = Qamasu(['test_worker.for_test_one', 'test_worker.for_test_fail'], instrumentation=metrics)
+    self.assertEquals(qamasu.manager.work_batch(1), 1)
+    self.assertEquals(qamasu.manager.work_batch(2), 1)
+    self.assertEquals(metrics.counters['jobs_total'],
+                      {'test_worker.for_test_one': 1, 'test_worker.for_test_fail': 1})
+    self.assertEquals(metrics.counters['job_failures_total'], {'test_worker.for_test_fail': 1})
+    self.assertEquals(metrics.counters['grab_misses_total'],
+                      {'test_worker.for_test_one': 0, 'test_worker.for_test_fail': 0})
+    self.assertEquals(metrics.summaries['find_job_seconds'][None][1], 2)
+    text = metrics.prometheus_text()
+    self.assertTrue('qamasu_jobs_total{func="test_worker.for_test_one"} 1' in text)
+    self.assertTrue('qamasu_job_duration_seconds_count{func="test_worker.for_test_fail"} 1' in text)
+    self.assertTrue('qamasu.test_worker_for_test_fail.job_failures_total:1|g' in metrics.statsd_lines())
+
+  def testStats(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.register_func('test_worker.for_test_fail')
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(3)])
+    self.qamasu.manager.find_job()
+    stats = self.qamasu.stats()
+    self.assertEquals(stats['test_worker.for_test_one']['ready'], 2)
+    self.assertEquals(stats['test_worker.for_test_one']['leased'], 1)
+    self.assertEquals(stats['test_worker.for_test_one']['delayed'], 0)
+    self.assertTrue(stats['test_worker.for_test_one']['oldest_enqueue_time'])
+    self.assertEquals(stats['test_worker.for_test_fail']['ready'], 0)
+
+    self.qamasu.manager.find_job()
+    self.assertEquals(self.qamasu.stats()['test_worker.for_test_one']['ready'], 2)
+    self.assertEquals(self.qamasu.stats(max_age=0)['test_worker.for_test_one']['ready'], 1)
+
+  def testRefreshStatsConcurrently(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.register_func('test_worker.for_test_fail')
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(3)])
+    errors = []
+    def refresh():
+      try:
+        Qamasu(['test_worker.for_test_one']).refresh_stats()
+      except Exception, e:
+        errors.append(e)
+      finally:
+        connection.close()
+    threads = [threading.Thread(target=refresh) for x in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEquals(errors, [])
+    self.assertEquals(QueueStat.objects.count(), 2)
+    self.assertEquals(self.qamasu.stats()['test_worker.for_test_one']['ready'], 3)
+
+  def testSerializer(self):
+    arg = dict(numbers=range(100), name=u'\u3042')
+    self.assertEquals(serializer.dumps(arg), json.dumps(arg, ensure_ascii=False))
+    self.assertEquals(serializer.loads(json.dumps(arg)), arg)
+    compressed = serializer.dumps(arg, compress_threshold=100)
+    self.assertTrue(compressed.startswith('!json+zlib:'))
+    self.assertTrue(len(compressed) < len(json.dumps(arg)))
+    self.assertEquals(serializer.loads(compressed), arg)
+    self.assertEquals(serializer.dumps(dict(number=1), compress_threshold=100), '{"number": 1}')
+    if 'msgpack' in serializer.SERIALIZERS:
+      self.assertEquals(serializer.loads(serializer.dumps(arg, 'msgpack')), arg)
+
+  def testCompressedArg(self):
+    qamasu = Qamasu(['test_worker.for_test_compress',])
+    qamasu.register_func('test_worker.for_test_compress')
+    qamasu.enqueue('test_worker.for_test_compress', dict(numbers=range(100)))
+    self.assertTrue(Job.objects.get().arg.startswith('!json+zlib:'))
+    job = qamasu.manager.find_job()
+    self.failIf(job._arg_loaded)
+    self.assertEquals(job.arg['numbers'], range(100))
+
+  def testOffloadArg(self):
+    qamasu = Qamasu(['test_worker.for_test_one',], grab_strategy=OptimisticGrabStrategy(),
+                    manager_options={'offload_threshold': 100})
+    qamasu.register_func('test_worker.for_test_one')
+    qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    qamasu.enqueue('test_worker.for_test_one', dict(number=2, numbers=range(100)))
+    qamasu.enqueue_many('test_worker.for_test_one', [dict(number=3, numbers=range(100))])
+    self.assertEquals(Payload.objects.count(), 2)
+    self.assertEquals(Job.objects.filter(payload_id__isnull=False, arg='').count(), 2)
+
+    # args are read at grab, a job completed first still has its arg.
+    job = qamasu.manager.find_job()
+    job.complete()
+    self.assertEquals(job.arg, dict(number=1))
+    job = qamasu.manager.find_job()
+    job.complete()
+    self.assertEquals(job.arg['numbers'], range(100))
+    self.assertEquals(Payload.objects.count(), 1)
+    qamasu.purge()
+    self.assertEquals(Payload.objects.count(), 0)
+
+  def testUniqueEnqueue(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1), uniqkey='one', unique=True)
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1), uniqkey='one', unique=True, priority=1)
+    self.assertEquals(self.qamasu.job_count(), 1)
+    self.assertEquals(Job.objects.get().priority, 1)
+    job = self.qamasu.manager.find_job()
+    self.assertEquals(job.uniqkey, 'one')
+    # a running job is not pending.
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1), uniqkey='one', unique=True)
+    self.assertEquals(self.qamasu.job_count(), 2)
+    job.complete()
+
+    count = self.qamasu.enqueue_many('test_worker.for_test_one',
+                                     [dict(key=key) for key in ('one', 'two', 'two', 'three')],
+                                     uniqkey=lambda arg: arg['key'], unique=True)
+    self.assertEquals(count, 2)
+    self.assertEquals(sorted(Job.objects.values_list('uniqkey', flat=True)), ['one', 'three', 'two'])
+
+    # values an insert-or-ignore would skip or truncate are rejected, not retried forever.
+    self.assertRaises(ValueError, self.qamasu.enqueue, 'test_worker.for_test_one', dict(number=1),
+                      uniqkey='four', unique=True, priority=-1)
+    self.assertRaises(ValueError, self.qamasu.enqueue_many, 'test_worker.for_test_one', [dict(number=1)],
+                      uniqkey=lambda arg: 'x' * 33, unique=True)
+    self.qamasu.manager._insert_unique = lambda jobs: 0
+    self.assertRaises(IntegrityError, self.qamasu.enqueue, 'test_worker.for_test_one', dict(number=1),
+                      uniqkey='four', unique=True)
+    self.assertEquals(self.qamasu.job_count(), 3)
+
+  def testUniqueEnqueueConcurrently(self):
+    if connection.vendor == 'sqlite':
+      self.skipTest('SQLite fails concurrent writing transactions with database is locked.')
+    self.qamasu.register_func('test_worker.for_test_one')
+    errors = []
+    def enqueue(number):
+      try:
+        qamasu = Qamasu(['test_worker.for_test_one'])
+        qamasu.enqueue('test_worker.for_test_one', dict(number=number), uniqkey='one', unique=True)
+        qamasu.enqueue_many('test_worker.for_test_one', [dict(number=number)],
+                            uniqkey=lambda arg: 'two', unique=True)
+      except Exception, e:
+        errors.append(e)
+      finally:
+        connection.close()
+    threads = [threading.Thread(target=enqueue, args=(number,)) for number in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEquals(errors, [])
+    self.assertEquals(sorted(Job.objects.values_list('dedup_key', flat=True)), ['one', 'two'])
+    # a grabbed job gives its uniqkey up.
+    job = self.qamasu.manager.find_job()
+    self.assertEquals(Job.objects.get(pk=job.id).dedup_key, None)
+    job.complete()
+
+  def testCoalesce(self):
+    qamasu = Qamasu(['test_worker.for_test_coalesce',])
+    qamasu.register_func('test_worker.for_test_coalesce')
+    for number in range(3):
+      qamasu.enqueue('test_worker.for_test_coalesce', dict(numbers=[number]), uniqkey='user-42')
+    qamasu.enqueue('test_worker.for_test_coalesce', dict(numbers=[9]), uniqkey='user-43')
+    self.assertEquals(qamasu.job_count(), 2)
+    self.assertEquals(qamasu.stats(max_age=0)['test_worker.for_test_coalesce']['delayed'], 2)
+    # runs after the window.
+    self.assertEquals(qamasu.manager.find_job(), None)
+    Job.objects.update(grabbed_until=datetime.now())
+    job = qamasu.manager.find_job()
+    self.assertEquals(job.arg, dict(numbers=[0, 1, 2]))
+
+    # a job grabbed while its arg is merged is not coalesced into, a new job is enqueued.
+    arg_data = qamasu.manager._arg_data
+    def grab_meanwhile(job_data):
+      Job.objects.filter(pk=job_data.pk).update(grab_token='other',
+                                                grabbed_until=datetime.now() + timedelta(seconds=50))
+      return arg_data(job_data)
+    qamasu.manager._arg_data = grab_meanwhile
+    qamasu.enqueue('test_worker.for_test_coalesce', dict(numbers=[10]), uniqkey='user-43')
+    del qamasu.manager._arg_data
+    self.assertEquals(qamasu.job_count(), 3)
+    self.assertEquals(Job.objects.filter(uniqkey='user-43', grab_token='').count(), 1)
+
+  def testRunAt(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1), delay=60)
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=2)], run_at=datetime.now() + timedelta(hours=1))
+    self.assertEquals(self.qamasu.manager.find_job(), None)
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=3), run_at=datetime.now() - timedelta(seconds=1))
+    self.assertEquals(self.qamasu.manager.find_job().arg['number'], 3)
+    self.assertEquals(self.qamasu.stats(max_age=0)['test_worker.for_test_one']['delayed'], 2)
+
+  def testSchedule(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    start_at = datetime.now() - timedelta(seconds=150)
+    self.qamasu.schedule('tick', 'test_worker.for_test_one', dict(number=1), 60, start_at=start_at)
+    self.assertEquals(self.qamasu.manager.materialize_schedules(), 1)
+    # missed runs are skipped.
+    self.assertEquals(Schedule.objects.get().next_run_at, start_at + timedelta(seconds=180))
+    self.assertEquals(self.qamasu.manager.materialize_schedules(), 0)
+    self.assertEquals(self.qamasu.work(work_delay=0, max_jobs=1), 1)
+    self.assertEquals(self.qamasu.job_count(), 0)
+    self.qamasu.unschedule('tick')
+    self.assertEquals(Schedule.objects.count(), 0)
+
+  def testWeightedScheduler(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.register_func('test_worker.for_test_two')
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(10)])
+    self.qamasu.enqueue_many('test_worker.for_test_two', [dict(number=n) for n in range(10)])
+    scheduler = WeightedScheduler({'test_worker.for_test_one': 2})
+    qamasu_w_both = Qamasu(['test_worker.for_test_one', 'test_worker.for_test_two'], scheduler=scheduler)
+    funcnames = []
+    for i in range(6):
+      job = qamasu_w_both.manager.find_job()
+      funcnames.append(job.funcname)
+      job.complete()
+    self.assertEquals(funcnames.count('test_worker.for_test_one'), 4)
+    jobs = qamasu_w_both.manager.find_jobs(3)
+    self.assertEquals(len(jobs), 3)
+
+  def testWeightedSchedulerBatch(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.register_func('test_worker.for_test_two')
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(40)])
+    self.qamasu.enqueue_many('test_worker.for_test_two', [dict(number=n) for n in range(40)])
+    scheduler = WeightedScheduler({'test_worker.for_test_one': 9})
+    qamasu_w_both = Qamasu(['test_worker.for_test_one', 'test_worker.for_test_two'], scheduler=scheduler)
+    funcnames = []
+    for n in (4, 16, 10):
+      jobs = qamasu_w_both.manager.find_jobs(n)
+      self.assertEquals(len(jobs), n)
+      for job in jobs:
+        funcnames.append(job.funcname)
+        job.complete()
+    self.assertEquals(funcnames.count('test_worker.for_test_one'), 27)
+    # a function lacking its share passes it to the others.
+    jobs = qamasu_w_both.manager.find_jobs(20)
+    self.assertEquals(len(jobs), 20)
+    self.assertEquals(len([job for job in jobs if job.funcname == 'test_worker.for_test_one']), 13)
+
+  def testWeightedSchedulerShares(self):
+    scheduler = WeightedScheduler({'a': 9})
+    for n in (1, 4, 16):
+      taken = 0
+      for i in range(10):
+        for funcname, share in scheduler.order(['a', 'b'], n):
+          scheduler.picked(['a', 'b'], funcname, share)
+          if funcname == 'a':
+            taken += share
+      self.assertEquals(taken, n * 9)
+
+  def testPriorityBandScheduler(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.register_func('test_worker.for_test_two')
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(3)])
+    self.qamasu.enqueue('test_worker.for_test_two', dict(number=9))
+    scheduler = PriorityBandScheduler({'test_worker.for_test_two': 1}, aging=60)
+    qamasu_w_both = Qamasu(['test_worker.for_test_one', 'test_worker.for_test_two'], scheduler=scheduler)
+    self.assertEquals(qamasu_w_both.manager.find_job().funcname, 'test_worker.for_test_one')
+    self.assertEquals(qamasu_w_both.manager.find_job().funcname, 'test_worker.for_test_one')
+    # waited for two aging periods.
+    scheduler.served['test_worker.for_test_two'] -= 120
+    self.assertEquals(qamasu_w_both.manager.find_job().funcname, 'test_worker.for_test_two')
+    self.assertEquals(qamasu_w_both.manager.find_job().funcname, 'test_worker.for_test_one')
+
+  def testBufferedCompletion(self):
+    qamasu = Qamasu(['test_worker.for_test_one',],
+                    manager_options={'completion_batch_size': 3, 'archive_retention': 3600})
+    qamasu.register_func('test_worker.for_test_one')
+    qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(5)])
+    for job in qamasu.manager.find_jobs(2):
+      job.complete()
+    self.assertEquals(qamasu.job_count(), 5)
+    qamasu.manager.find_job().complete()
+    self.assertEquals(qamasu.job_count(), 2)
+    self.assertEquals(CompletedJob.objects.count(), 3)
+    # flushed when work ends.
+    self.assertEquals(qamasu.work(work_delay=0, max_jobs=2), 2)
+    self.assertEquals(qamasu.job_count(), 0)
+    self.assertEquals(CompletedJob.objects.count(), 5)
+    CompletedJob.objects.update(completed_at=datetime.now() - timedelta(hours=2))
+    qamasu.manager.prune_archive()
+    self.assertEquals(CompletedJob.objects.count(), 0)
+
+    # flushed before waiting for jobs.
+    qamasu = Qamasu(['test_worker.for_test_one',],
+                    manager_options={'completion_batch_size': 100, 'completion_flush_seconds': 3600})
+    qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(2)])
+    waited = []
+    def wait(timeout):
+      waited.append(qamasu.job_count())
+      qamasu.gentle_terminate = True
+    qamasu.manager.notifier.wait = wait
+    qamasu.work(work_delay=0)
+    self.assertEquals(waited, [0])
+
+    # flushed in the background, and not deleted once another worker grabbed it.
+    qamasu = Qamasu(['test_worker.for_test_one',],
+                    manager_options={'completion_batch_size': 100, 'completion_flush_seconds': 0.1})
+    qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(2)])
+    jobs = qamasu.manager.find_jobs(2)
+    jobs[0].complete()
+    time.sleep(0.5)
+    self.assertEquals(qamasu.job_count(), 1)
+    Job.objects.filter(pk=jobs[1].id).update(grab_token='other')
+    jobs[1].complete()
+    qamasu.manager.close()
+    self.assertEquals(qamasu.job_count(), 1)
+
+  def testReplayFailedJobs(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    func = Func.objects.get(name='test_worker.for_test_one')
+    for number in range(5):
+      ExceptionLog(func=func, message='failed %d' % (number % 2), arg='{"number": %d}' % number,
+                   uniqkey='key%d' % number).save()
+    self.assertEquals(self.qamasu.replay_failed_jobs(funcs=['test_worker.for_test_one'], message='failed 1',
+                                                     chunk_size=1), 2)
+    self.assertEquals(ExceptionLog.objects.count(), 3)
+    self.assertEquals(sorted(Job.objects.values_list('uniqkey', flat=True)), ['key1', 'key3'])
+    self.assertEquals(self.qamasu.manager.find_job().arg, dict(number=1))
+    # each chunk is committed; a failing chunk keeps its logs.
+    stored_arg = self.qamasu.manager._stored_arg
+    def failing_stored_arg(data):
+      if data == '{"number": 2}':
+        raise ValueError(data)
+      return stored_arg(data)
+    self.qamasu.manager._stored_arg = failing_stored_arg
+    self.assertRaises(ValueError, self.qamasu.replay_failed_jobs, message='failed 0', chunk_size=1)
+    del self.qamasu.manager._stored_arg
+    self.assertEquals(sorted(ExceptionLog.objects.values_list('uniqkey', flat=True)), ['key2', 'key4'])
+    Job.objects.filter(uniqkey='key0').delete()
+    ExceptionLog(func=func, message='failed 0', arg='{"number": 0}', uniqkey='key0').save()
+
+    ExceptionLog.objects.filter(uniqkey__in=['key0', 'key2']).update(
+      exception_time=datetime.now() - timedelta(days=2))
+    self.assertEquals(self.qamasu.prune_exceptions(86400, chunk_size=1), 2)
+    self.assertEquals(list(ExceptionLog.objects.values_list('uniqkey', flat=True)), ['key4'])
+    ExceptionLog.objects.all().delete()
+
+  def testPrefetch(self):
+    qamasu = Qamasu(['test_worker.for_test_one',],
+                    manager_options={'prefetch': 3, 'prefetch_in_background': False})
+    qamasu.register_func('test_worker.for_test_one')
+    qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(5)])
+    job = qamasu.manager.find_job()
+    self.assertEquals(job.arg['number'], 0)
+    self.assertEquals(Job.objects.exclude(grab_token='').count(), 3)
+    job.complete()
+    # an expiring grab is extended before the job is served.
+    for prefetched in qamasu.manager._prefetched:
+      prefetched.grabbed_until = datetime.now()
+    for number in (1, 2, 3):
+      job = qamasu.manager.find_job()
+      self.assertEquals(job.arg['number'], number)
+      self.assertTrue(Job.objects.get(pk=job.id).grabbed_until > datetime.now())
+      job.complete()
+    qamasu.manager.close()
+    # the prefetched job is released.
+    job = self.qamasu.manager.find_job()
+    self.assertEquals(job.arg['number'], 4)
+
+  def testPrefetchInBackground(self):
+    qamasu = Qamasu(['test_worker.for_test_one',], manager_options={'prefetch': 2})
+    qamasu.register_func('test_worker.for_test_one')
+    qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(5)])
+    self.assertEquals(qamasu.work(work_delay=0, max_jobs=5), 5)
+    self.assertEquals(qamasu.job_count(), 0)
+
+  def testBatchWorker(self):
+    qamasu = Qamasu(['test_worker.for_test_batch', 'test_worker.for_test_one'])
+    qamasu.register_func('test_worker.for_test_batch')
+    qamasu.register_func('test_worker.for_test_one')
+    qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    qamasu.enqueue_many('test_worker.for_test_batch', [dict(number=n) for n in range(1, 8)])
+    # a batch is filled up to BATCH_SIZE with jobs of its function.
+    self.assertEquals(qamasu.manager.work_batch(2), 4)
+    self.assertEquals(qamasu.job_count(funcs=['test_worker.for_test_batch']), 4)
+    self.assertEquals(qamasu.work(work_delay=0, max_jobs=4), 4)
+    self.assertEquals(qamasu.job_count(), 0)
+    # jobs are failed one by one, or all but completed ones when work_batch raises.
+    qamasu.enqueue_many('test_worker.for_test_batch', [dict(number=n) for n in (-1, 2, 3, 4, 0, 5)])
+    self.assertEquals(qamasu.work(work_delay=0, max_jobs=6), 6)
+    self.assertEquals(qamasu.job_count(), 0)
+    self.assertEquals(sorted(json.loads(log.arg)['number'] for log in ExceptionLog.objects.all()), [-1, 0, 5])
+
   def testNoAbility(self):
     try:
       self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
@@ -269,3 +989,201 @@ class QamasuTestCase(unittest.TestCase):
     self.qamasu.purge()
 
 
+@unittest.skipIf(fakeredis is None, 'fakeredis stands in for a Redis server.')
+class RedisManagerTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.qamasu = Qamasu(['test_worker.for_test_one', 'test_worker.for_test_fail'],
+                         manager_class=RedisManager,
+                         manager_options={'client': fakeredis.FakeStrictRedis()})
+
+  def testWork(self):
+    self.assertTrue(self.qamasu.register_func('test_worker.for_test_one'))
+    self.assertFalse(self.qamasu.register_func('test_worker.for_test_one'))
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(2, 5)],
+                             chunk_size=2)
+    self.assertEquals(self.qamasu.job_count(), 4)
+    jobs = self.qamasu.manager.find_jobs(2)
+    self.assertEquals([job.arg['number'] for job in jobs], [1, 2])
+    self.assertEquals(self.qamasu.stats()['test_worker.for_test_one']['leased'], 2)
+    self.assertTrue(jobs[0].extend(10))
+    jobs[0].complete()
+    self.assertFalse(jobs[0].extend(10))
+    # work gets jobs[1] back now, not after its GRAB_FOR.
+    self.qamasu.manager.release(jobs[1:])
+    self.assertEquals(self.qamasu.work(work_delay=0, max_jobs=3), 3)
+    self.assertEquals(self.qamasu.job_count(), 0)
+
+  def testPriority(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1), priority=9)
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=2), priority=1)
+    self.assertEquals(self.qamasu.manager.find_job(prioritizing=True).arg['number'], 2)
+
+  def testExpiredGrab(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    job = self.qamasu.manager.find_job()
+    self.assertEquals(self.qamasu.manager.find_job(), None)
+    job.extend(-1)
+    regrabbed = self.qamasu.manager.find_job()
+    self.assertEquals(regrabbed.id, job.id)
+    self.assertFalse(job.extend(10))
+
+  def testRunAt(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1), delay=60)
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=2), run_at=datetime.now() - timedelta(seconds=1))
+    self.assertEquals(self.qamasu.manager.find_job().arg['number'], 2)
+    self.assertEquals(self.qamasu.manager.find_job(), None)
+    self.assertEquals(self.qamasu.stats()['test_worker.for_test_one']['delayed'], 1)
+
+  def testRetryAndFail(self):
+    self.qamasu.register_func('test_worker.for_test_fail')
+    self.qamasu.enqueue('test_worker.for_test_fail', dict(number=1))
+    self.assertEquals(self.qamasu.work(work_delay=0, max_jobs=3), 3)
+    self.assertEquals(self.qamasu.job_count(), 0)
+    failed = self.qamasu.manager.failed_jobs('test_worker.for_test_fail')
+    self.assertEquals([f['message'] for f in failed], ['failed 1'])
+
+  def testReplayFailedJobs(self):
+    self.qamasu.register_func('test_worker.for_test_fail')
+    self.qamasu.enqueue_many('test_worker.for_test_fail', [dict(number=n) for n in range(1, 4)])
+    self.assertEquals(self.qamasu.work(work_delay=0, max_jobs=9), 9)
+    self.assertEquals(self.qamasu.replay_failed_jobs(message='failed 2'), 1)
+    self.assertEquals(self.qamasu.manager.find_job().arg['number'], 2)
+    self.assertEquals(self.qamasu.replay_failed_jobs(until=datetime.now() - timedelta(days=1)), 0)
+    self.assertEquals(self.qamasu.replay_failed_jobs(chunk_size=1), 2)
+    self.assertEquals(self.qamasu.manager.failed_jobs('test_worker.for_test_fail'), [])
+    self.assertEquals(self.qamasu.job_count(), 3)
+
+  def testLookupAndReenqueue(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    enqueued = self.qamasu.manager.enqueue('test_worker.for_test_one', dict(number=1), 'key1')
+    self.assertEquals(self.qamasu.manager.lookup_job(0), None)
+    job = self.qamasu.manager.lookup_job(enqueued.id)
+    self.assertEquals(job.arg['number'], 1)
+    self.assertEquals(self.qamasu.manager.lookup_job(enqueued.id), None)
+    job.reenqueue(dict(retry_cnt=3, grab_token='ignored'))
+    job.extend(-1)
+    self.assertEquals(self.qamasu.manager.lookup_job(enqueued.id).org_job.retry_cnt, 3)
+
+  def testSchedule(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.schedule('every minute', 'test_worker.for_test_one', dict(number=1), 60,
+                         start_at=datetime.now() - timedelta(seconds=150))
+    self.assertEquals(self.qamasu.manager.materialize_schedules(), 1)
+    # missed runs are enqueued once.
+    self.assertEquals(self.qamasu.manager.materialize_schedules(), 0)
+    self.assertEquals(self.qamasu.manager.find_job().arg['number'], 1)
+    self.qamasu.unschedule('every minute')
+    self.qamasu.manager.client.zadd(self.qamasu.manager._key('schedule_runs'), {'every minute': 0})
+    self.assertEquals(self.qamasu.manager.materialize_schedules(), 0)
+
+  def testBatchWorker(self):
+    qamasu = Qamasu(['test_worker.for_test_batch',], manager_class=RedisManager,
+                    manager_options={'client': fakeredis.FakeStrictRedis()})
+    qamasu.register_func('test_worker.for_test_batch')
+    qamasu.enqueue_many('test_worker.for_test_batch', [dict(number=n) for n in range(1, 6)])
+    self.assertEquals(qamasu.manager.work_once(), None)
+    self.assertEquals(qamasu.job_count(), 2)
+    self.assertEquals(qamasu.work(work_delay=0, max_jobs=2), 2)
+    self.assertEquals(qamasu.job_count(), 0)
+
+  def testNoCoalesce(self):
+    self.qamasu.register_func('test_worker.for_test_coalesce')
+    self.assertRaises(NotImplementedError, self.qamasu.enqueue, 'test_worker.for_test_coalesce',
+                      dict(numbers=[1]), uniqkey='user-42')
+    self.assertRaises(NotImplementedError, self.qamasu.enqueue_many, 'test_worker.for_test_coalesce',
+                      [dict(numbers=[1])], uniqkey=lambda arg: 'user-42')
+
+  def testNoAbility(self):
+    try:
+      self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+      self.fail()
+    except Func.DoesNotExist:
+      pass
+
+
+class ShardedManagerTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.qamasu = self.sharded()
+
+  def sharded(self, **options):
+    options['databases'] = ['default', 'shard1']
+    return Qamasu(['test_worker.for_test_one', 'test_worker.for_test_fail'],
+                  manager_class=ShardedManager, manager_options=options)
+
+  def testShardByUniqkey(self):
+    self.qamasu = self.sharded(shard_by='uniqkey')
+    self.assertTrue(self.qamasu.register_func('test_worker.for_test_one'))
+    self.assertEquals(Func.objects.using('shard1').count(), 1)
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(20)],
+                             uniqkey=lambda arg: str(arg['number']), unique=True, chunk_size=7)
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=0), uniqkey='0', unique=True)
+    expected = [0, 0]
+    for n in range(20):
+      expected[shard_index(str(n), 2)] += 1
+    self.assertTrue(0 not in expected)
+    self.assertEquals([Job.objects.using(alias).count() for alias in ('default', 'shard1')], expected)
+    self.assertEquals(self.qamasu.job_count(), 20)
+    self.assertEquals(self.qamasu.stats()['test_worker.for_test_one']['ready'], 20)
+    self.assertEquals(len(self.qamasu.manager.find_jobs(15)), 15)
+    self.assertEquals(self.qamasu.work(work_delay=0, max_jobs=5), 5)
+    self.assertEquals(self.qamasu.job_count(), 15)
+
+  def testShardByFunc(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(2, 5)])
+    alias = ['default', 'shard1'][shard_index('test_worker.for_test_one', 2)]
+    self.assertEquals(Job.objects.using(alias).count(), 4)
+    self.assertEquals(self.qamasu.work(work_delay=0, max_jobs=4), 4)
+    self.assertEquals(self.qamasu.job_count(), 0)
+
+  def testLookupJob(self):
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue('test_worker.for_test_one', dict(number=1))
+    alias = ['default', 'shard1'][shard_index('test_worker.for_test_one', 2)]
+    job_id = Job.objects.using(alias).get().id
+    job = self.qamasu.manager.lookup_job(job_id)
+    self.assertEquals(job.arg['number'], 1)
+    self.assertEquals(job.manager.using, alias)
+    self.assertEquals(self.qamasu.manager.lookup_job(job_id), None)
+    job.complete()
+
+  def testDepthPolling(self):
+    self.qamasu = self.sharded(shard_by='uniqkey', polling='depth')
+    self.qamasu.register_func('test_worker.for_test_one')
+    self.qamasu.enqueue_many('test_worker.for_test_one', [dict(number=n) for n in range(10)],
+                             uniqkey=lambda arg: str(arg['number']))
+    jobs = self.qamasu.manager.find_jobs(10)
+    self.assertEquals(sorted(job.arg['number'] for job in jobs), range(10))
+    self.assertEquals(self.qamasu.manager.find_job(), None)
+    jobs[0].complete()
+    self.qamasu.manager.release(jobs[1:])
+    self.assertEquals(self.qamasu.stats(max_age=0)['test_worker.for_test_one']['ready'], 9)
+    # depths are the ready jobs of the cached stats.
+    for alias in ('default', 'shard1'):
+      QueueStat.objects.using(alias).update(ready=7)
+    self.qamasu.manager._depth_checked = 0
+    self.qamasu.manager._polled_shards()
+    self.assertEquals(self.qamasu.manager._depths, [7, 7])
+
+  def testReplayFailedJobs(self):
+    self.qamasu = self.sharded(shard_by='uniqkey')
+    self.qamasu.register_func('test_worker.for_test_fail')
+    for n in range(4):
+      self.qamasu.enqueue('test_worker.for_test_fail', dict(number=n), uniqkey='key%d' % n)
+    self.assertEquals(self.qamasu.work(work_delay=0, max_jobs=12), 12)
+    self.assertEquals(sum(ExceptionLog.objects.using(alias).count() for alias in ('default', 'shard1')), 4)
+    self.assertEquals(self.qamasu.replay_failed_jobs(), 4)
+    self.assertEquals(self.qamasu.job_count(), 4)
+
+  def tearDown(self):
+    self.qamasu.purge()
+    for alias in ('default', 'shard1'):
+      ExceptionLog.objects.using(alias).all().delete()
+      Func.objects.using(alias).all().delete()
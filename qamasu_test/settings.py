@@ -17,7 +17,15 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
-    }
+        # a file, as threads of the concurrency tests do not share an in-memory database.
+        'TEST_NAME': '/tmp/qamasu_test.sqlite',
+    },
+    # the second shard of qamasu.sharding tests.
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': '/tmp/data_shard1.sqlite',
+        'TEST_NAME': '/tmp/qamasu_test_shard1.sqlite',
+    },
 }
 
 # Local time zone for this installation. Choices can be found here:
@@ -81,6 +89,9 @@ STATICFILES_FINDERS = (
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = 'qjl974s2v7r@ln#0pb9+v+y5fj+@v@8r(ays0uxgbm3s1&amp;q!7o'
 
+# the test runner of Django 1.6 and later.
+TEST_RUNNER = 'django.test.runner.DiscoverRunner'
+
 # List of callables that know how to import templates from various sources.
 TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.Loader',
@@ -15,8 +15,8 @@ Implemented using optimistic lock.
 Requirements
 --------------------------------------
 
-* Python>=2.6
-* Django>=1.0
+* Python 2.7
+* Django 1.7 or 1.8
 
 Usage
 --------------------------------------
@@ -28,7 +28,31 @@ Qamasu is a Django application.
 
 You need add qamasu to your or new django project's INSTALLED_APPS.
 
-And //manage.py syncdb//.
+And //manage.py migrate//.
+
+Upgrade from a database created by syncdb
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+Tables created by syncdb with an earlier Qamasu are those of the first migration.
+Mark it applied and migrate the rest.
+::
+
+  $ python manage.py migrate qamasu 0001 --fake
+  $ python manage.py migrate qamasu
+
+Or apply the changes by hand(//manage.py sqlmigrate qamasu 0002// ... prints them for your backend)
+and mark all of them applied with //manage.py migrate qamasu --fake//.
+Existing tables change as follows on PostgreSQL, the other migrations create new tables.
+::
+
+  ALTER TABLE qamasu_job ADD COLUMN payload_id integer NULL CHECK (payload_id >= 0);
+  ALTER TABLE qamasu_job ADD COLUMN grab_token varchar(32) DEFAULT '' NOT NULL;
+  ALTER TABLE qamasu_job ALTER COLUMN grab_token DROP DEFAULT;
+  CREATE INDEX qamasu_job_grab_token ON qamasu_job (grab_token);
+  CREATE INDEX qamasu_job_due ON qamasu_job (func_id, grabbed_until);
+  CREATE INDEX qamasu_job_ready_priority ON qamasu_job (func_id, priority, id);
+  CREATE INDEX qamasu_exceptionlog_exception_time ON qamasu_exceptionlog (exception_time);
+  ALTER TABLE qamasu_job ADD COLUMN dedup_key varchar(32) NULL;
+  ALTER TABLE qamasu_job ADD CONSTRAINT qamasu_job_func_id_dedup_key_uniq UNIQUE (func_id, dedup_key);
 
 Write your worker.
 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
@@ -37,6 +61,36 @@ Define **GRAB_FOR** in seconds that is max time worker grabbed for a work.
 
 Define **def work_safely(manager, job):** that is a work you need.
 
+Define **HEARTBEAT** in seconds optionally. The grab of a running job is renewed by GRAB_FOR
+every HEARTBEAT seconds, so a short GRAB_FOR is enough for long running jobs
+and jobs of crashed workers are grabbed again soon.
+work_safely can also call **job.extend(seconds)** by itself.
+
+A job raising an exception is retried with exponential backoff, RETRY_SECONDS doubled for every retry.
+After MAX_RETRIES retries it is moved to ExceptionLog.
+Define **MAX_RETRIES** and **RETRY_SECONDS** optionally to override them per worker.
+
+Args are stored as JSON. Define **SERIALIZER** = 'msgpack'(needs msgpack) and/or
+**COMPRESS_THRESHOLD** in bytes optionally to store them in binary, zlib compressed
+from that size. Stored args are tagged with their format, so changing them keeps
+queued jobs readable. job.arg is decoded when the worker first reads it.
+
+Define **COALESCE_WINDOW** in seconds optionally to run a burst of jobs once. A job enqueued
+with a uniqkey runs COALESCE_WINDOW seconds later, and jobs enqueued with the same uniqkey
+until then are merged into it, keeping the latest arg or by **def merge_args(old_arg, new_arg):**.
+
+Define **def work_batch(manager, jobs):** and **BATCH_SIZE** instead of work_safely for jobs
+processed faster together, like bulk writes. A grabbed job of the worker is passed with
+up to BATCH_SIZE - 1 more jobs of the function. Call job.complete() or **job.fail(exception)**
+for each job; if work_batch raises, the jobs not completed nor failed yet are retried.::
+
+    BATCH_SIZE = 100
+
+    def work_batch(manager, jobs):
+      Entry.objects.bulk_create([Entry(**job.arg) for job in jobs])
+      for job in jobs:
+        job.complete()
+
 See `sample worker`_ in workers directory for detail.
 
 .. _`sample worker`: http://bitbucket.org/tsuyukimakoto/qamasu/src/tip/workers/random_wait.py
@@ -66,10 +120,41 @@ Add hundreds Queues.::
           arg = dict(random_number=uniform(1,5))
           qamasu.enqueue('workers.random_wait', arg)
 
+Add many Queues at once. args is inserted in chunks, so a generator is fine.::
+
+    >>> args = (dict(random_number=uniform(1,5)) for x in xrange(1,100000))
+    >>> qamasu.enqueue_many('workers.random_wait', args)
+    99999
+
 Add a highest-priority queue.::
 
     >>> qamasu.enqueue('workers.random_wait', dict(random_number=uniform(1,5)), priority=1)
 
+Add a queue for later with run_at(datetime) or delay(seconds).::
+
+    >>> qamasu.enqueue('workers.random_wait', dict(random_number=1), delay=600)
+
+Schedule a recurring job. Working qamasu enqueues its next run when it comes,
+once even if runs were missed while nobody was working.::
+
+    >>> qamasu.schedule('hourly-wait', 'workers.random_wait', dict(random_number=1), 3600)
+    >>> qamasu.unschedule('hourly-wait')
+
+Enqueue with unique=True to skip a job whose uniqkey is already pending, queued or waiting
+for retry but not running. A given higher priority is applied to the pending job.
+enqueue_many takes a function returning the uniqkey of an arg.::
+
+    >>> qamasu.enqueue('workers.random_wait', dict(user=1), uniqkey='user-1', unique=True)
+    >>> qamasu.enqueue_many('workers.random_wait', args, uniqkey=lambda arg: 'user-%d' % arg['user'], unique=True)
+
+A queued job keeps its uniqkey in a unique column until it is grabbed, so producers
+enqueueing the same uniqkey at the same moment insert one job.
+
+A serialized arg of 64KB or more is stored in its own Payload row, so looking for jobs
+never reads it; only the grabbed job loads it. Change the size by manager_options.::
+
+    >>> qamasu = Qamasu(['workers.random_wait',], manager_options={'offload_threshold': 16 * 1024})
+
 Work! Work! Work!
 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
 Process enqueued job.
@@ -92,6 +177,178 @@ Use work_prioritizing method if you tend to process job respects to priority.
     >>> qamasu = Qamasu(['workers.random_wait',])
     >>> qamasu.work_prioritizing()
 
+Use work_pool method to run several worker processes.
+Workers are restarted when they exit, and after max_jobs jobs if it is given.
+A worker is restarted restart_seconds(1 by default) after the start of the last one at the earliest,
+so workers failing at once do not fork in a tight loop.
+SIGTERM terminates all workers gently.
+::
+
+    >>> from qamasu import Qamasu
+    >>> qamasu = Qamasu(['workers.random_wait',])
+    >>> qamasu.work_pool(processes=8, max_jobs=1000)
+
+Or use qamasu_work command.
+::
+
+  $ python manage.py qamasu_work workers.random_wait --processes=8 --max-jobs=1000
+
+Use concurrency for I/O bound workers. Up to concurrency jobs are run at once on a thread pool.
+::
+
+    >>> qamasu.work(concurrency=16)
+
+Use batch_size if you want to grab several jobs at once.
+Jobs are grabbed with a single UPDATE and processed before polling again.
+The grab of a job is extended before it runs when half of GRAB_FOR has passed,
+and a job whose grab ran out meanwhile is left to the worker that grabbed it again.
+::
+
+    >>> from qamasu import Qamasu
+    >>> qamasu = Qamasu(['workers.random_wait',])
+    >>> qamasu.work(batch_size=20)
+
+For very short jobs, set prefetch to grab that many jobs ahead and serve them from memory.
+They are refilled in the background when half of them are served, their grabs are extended
+when half of GRAB_FOR has passed before they run, and the rest are released when work ends.::
+
+    >>> qamasu = Qamasu(['workers.random_wait',], manager_options={'prefetch': 20})
+
+Completed jobs are deleted one by one. Set completion_batch_size to delete them together
+when that many are completed or after completion_flush_seconds(also during a long job),
+when the queue is empty and when work ends(e.g. by handle_terminate). A job is flushed at once
+when its grab would end before, and it is deleted only if its grab is still the worker's. Set archive_retention in seconds to keep completed jobs
+without their args in CompletedJob for that long.::
+
+    >>> qamasu = Qamasu(['workers.random_wait',],
+    ...                 manager_options={'completion_batch_size': 100, 'archive_retention': 86400})
+
+Wake up
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+Idle workers wait on a notifier which enqueue signals.
+work_delay is the longest time a worker waits without a signal.
+
+* PostgreSQL uses LISTEN/NOTIFY by default.
+* Other backends poll with exponential backoff up to work_delay.
+* Workers on a single host can use unix sockets. Pass the same notifier to producers and workers.
+
+::
+
+    >>> from qamasu import Qamasu, SocketNotifier
+    >>> qamasu = Qamasu(['workers.random_wait',], notifier=SocketNotifier('/var/run/qamasu'))
+    >>> qamasu.work()
+
+Grab strategy
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+On backends supporting SELECT ... FOR UPDATE SKIP LOCKED (PostgreSQL 9.5, MySQL 8),
+Qamasu locks candidate rows so that concurrent workers grab disjoint jobs.
+Other backends use the optimistic lock. You can choose the strategy explicitly.
+::
+
+    >>> from qamasu import Qamasu, OptimisticGrabStrategy
+    >>> qamasu = Qamasu(['workers.random_wait',], grab_strategy=OptimisticGrabStrategy())
+
+Compare strategies under contention with the benchmark module.
+::
+
+  $ DJANGO_SETTINGS_MODULE=qamasu_test.settings python -m qamasu.benchmark contention
+
+Fair scheduling
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+A worker with several abilities takes the oldest job of all of them, so a large backlog
+of one function delays the others. Give it a scheduler to serve functions by weight,
+or by bands rising every aging seconds while waiting. Jobs are looked up function by function,
+and a batch of find_jobs(n) is split among functions by their weights.
+::
+
+    >>> from qamasu import Qamasu, WeightedScheduler, PriorityBandScheduler
+    >>> qamasu = Qamasu(['workers.mail', 'workers.report'],
+    ...                 scheduler=WeightedScheduler({'workers.mail': 9, 'workers.report': 1}))
+    >>> qamasu = Qamasu(['workers.mail', 'workers.report'],
+    ...                 scheduler=PriorityBandScheduler({'workers.report': 1}, aging=60))
+
+Failed jobs
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+Replay failed jobs in bulk, selected by functions, exception_time range and a part of
+the message. Logs are replayed chunk_size at a time, each chunk enqueued and its logs
+deleted in one transaction.
+::
+
+    >>> qamasu.replay_failed_jobs(funcs=['workers.random_wait'], since=outage_started, message='Timeout')
+    1234
+
+Delete old exception logs in chunks, so the table is not locked for long.
+::
+
+  $ python manage.py qamasu_prune_exceptions --days=30
+
+Statistics
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+stats method returns the number of ready, leased and delayed jobs and the oldest enqueue_time
+per function. They are cached in a table and recounted when older than max_age seconds,
+so polling it often costs almost nothing.
+::
+
+    >>> qamasu.stats(max_age=30)
+    {u'workers.random_wait': {'ready': 498, 'leased': 1, 'delayed': 0, 'oldest_enqueue_time': datetime.datetime(...)}}
+
+Metrics
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+Pass Metrics as instrumentation to count grab attempts and misses, queue wait time,
+duration and failures of jobs. Export them in the Prometheus text format, as a file or
+from a local endpoint, or send them to StatsD. Without instrumentation nothing is measured.
+::
+
+    >>> from qamasu import Qamasu, Metrics
+    >>> metrics = Metrics()
+    >>> qamasu = Qamasu(['workers.random_wait',], instrumentation=metrics)
+    >>> metrics.serve(9100)
+    >>> qamasu.work()
+
+Subclass Instrumentation to hook the measurements by yourself.
+
+Benchmark
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+qamasu_benchmark command reports jobs/sec, pickup latency and queries per job
+of enqueue, find_job, complete and work as JSON. It purges all jobs!
+::
+
+  $ python manage.py qamasu_benchmark --backlog=1000,100000 --workers=1,8 --payload=10,10000 --output=bench.json
+
+Redis backend
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+RedisManager keeps jobs in Redis(redis-py 3 or later) instead of the database,
+taking polling and grabbing off the database. Workers and enqueue work the same way.
+::
+
+    >>> import redis
+    >>> from qamasu import Qamasu
+    >>> from qamasu.redis_backend import RedisManager
+    >>> qamasu = Qamasu(['workers.random_wait',], manager_class=RedisManager,
+    ...                 manager_options={'client': redis.StrictRedis()})
+
+Failed jobs go to a list in Redis(RedisManager.failed_jobs), not to ExceptionLog, and
+replay_failed_jobs enqueues them again. Schedules are kept in Redis too.
+job_list, exception_list and func_list are for the database only,
+and so are unique enqueue and COALESCE_WINDOW(NotImplementedError).
+
+Sharding
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+ShardedManager spreads jobs over several databases of DATABASES, each having all tables
+of qamasu(//manage.py migrate --database=queue1//). Jobs are routed by their function,
+or by their uniqkey with shard_by='uniqkey'. Workers poll shards in turn, or weighted by
+their ready jobs in stats with polling='depth'. stats, job_count, purge and failed jobs methods
+cover all shards.
+::
+
+    >>> from qamasu import Qamasu
+    >>> from qamasu.sharding import ShardedManager
+    >>> qamasu = Qamasu(['workers.random_wait',], manager_class=ShardedManager,
+    ...                 manager_options={'databases': ['queue0', 'queue1'], 'shard_by': 'uniqkey'})
+
+job_list, exception_list and func_list show the default database only. Job ids are per shard,
+so lookup_job grabs the job of the first shard having a ready job of the id.
+
 Caution!
 --------------------------------------
 
@@ -124,7 +381,6 @@ setup(
         "Intended Audience :: Developers",
         "License :: OSI Approved :: BSD License",
         "Operating System :: OS Independent",
-        "Programming Language :: Python :: 2.6",
         "Programming Language :: Python :: 2.7",
         "Topic :: System :: Distributed Computing",
     ],
@@ -133,8 +389,8 @@ setup(
     author_email='mtsuyuki@gmail.com',
     url='http://bitbucket.org/tsuyukimakoto/qamasu',
     license='New BSD',
-    packages=['qamasu'],
+    packages=['qamasu', 'qamasu.migrations', 'qamasu.management', 'qamasu.management.commands'],
     install_requires=[
-        "Django >= 1.0",],
+        "Django >= 1.7, < 1.9",],
     zip_safe=True,
 )
@@ -0,0 +1,12 @@
+GRAB_FOR = 50
+BATCH_SIZE = 3
+MAX_RETRIES = 0
+
+def work_batch(manager, jobs):
+  for job in jobs:
+    if job.arg['number'] < 0:
+      job.fail(ValueError('negative %d' % job.arg['number']))
+    elif job.arg['number'] == 0:
+      raise ValueError('zero')
+    else:
+      job.complete()
@@ -0,0 +1,8 @@
+GRAB_FOR = 50
+COALESCE_WINDOW = 60
+
+def merge_args(old_arg, new_arg):
+  return dict(numbers=old_arg['numbers'] + new_arg['numbers'])
+
+def work_safely(manager, job):
+  job.complete()
@@ -0,0 +1,5 @@
+GRAB_FOR = 50
+COMPRESS_THRESHOLD = 100
+
+def work_safely(manager, job):
+  job.complete()
@@ -0,0 +1,6 @@
+GRAB_FOR = 50
+MAX_RETRIES = 2
+RETRY_SECONDS = 0
+
+def work_safely(manager, job):
+  raise ValueError('failed %d' % job.arg['number'])